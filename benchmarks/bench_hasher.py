@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+"""
+Compares the hashlib backed Hasher against the pure Python PyHasher on
+room names, and checks both give the same server lookups in tshashes.
+
+    python benchmarks/bench_hasher.py
+"""
+
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chatango.hasher import Hasher, PyHasher
+from chatango.utils import specials, tshashes
+
+NAMES = 2000
+
+
+def main():
+    rng = random.Random(1)
+    alphabet = string.ascii_lowercase + string.digits + "-"
+    names = list(specials) + [
+        "".join(rng.choice(alphabet) for _ in range(rng.randint(3, 20)))
+        for _ in range(NAMES)
+    ]
+    for name in names:
+        expected = PyHasher().hash(name)
+        assert Hasher().hash(name) == expected
+        assert tshashes.get(Hasher().hash(name)) == tshashes.get(expected)
+
+    number = 5
+    t_py = timeit.timeit(lambda: [PyHasher().hash(n) for n in names], number=number)
+    t_md5 = timeit.timeit(lambda: [Hasher().hash(n) for n in names], number=number)
+    per_name = number * len(names)
+    print(
+        f"{len(names)} names  PyHasher {t_py / per_name * 1e6:8.2f}us  "
+        f"Hasher {t_md5 / per_name * 1e6:8.2f}us  x{t_py / t_md5:.0f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+"""
+Measures chatango import time with python -X importtime for a few
+typical entry points, and reports which heavy dependencies each one
+pulls in.
+
+    python benchmarks/bench_import.py
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+RUNS = 5
+STATEMENTS = [
+    "import chatango",
+    "from chatango import UserManager",
+    "from chatango import MessageHistory",
+    "from chatango import Room",
+    "from chatango import Client",
+]
+HEAVY = ["aiohttp", "ssl", "xml.etree.ElementTree", "mimetypes", "ctypes"]
+
+
+def importtime(statement):
+    """Total import time in microseconds and the set of imported modules."""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total, modules = 0, set()
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if not match:
+            continue
+        modules.add(match.group(4))
+        # Top level imports are indented by a single space
+        if len(match.group(3)) == 1:
+            total += int(match.group(2))
+    return total, modules
+
+
+def main():
+    for statement in STATEMENTS:
+        results = [importtime(statement) for _ in range(RUNS)]
+        best = min(total for total, _ in results)
+        heavy = [name for name in HEAVY if name in results[0][1]]
+        print(f"{statement:<40} {best / 1000:7.1f}ms  {', '.join(heavy) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
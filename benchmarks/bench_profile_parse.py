@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+"""
+Compares the profile XML parsing of _find_xml_element with the previous
+regex plus ElementTree.fromstring approach on profile documents of several sizes,
+including profiles with a huge HTML body.
+
+    python benchmarks/bench_profile_parse.py
+"""
+
+import os
+import re
+import sys
+import timeit
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chatango.resources import (
+    MessageBackground,
+    RoomProfile,
+    UserProfile,
+    _find_xml_element,
+)
+
+PROLOG = '<?xml version="1.0" ?>'
+
+
+def fromstring_mod1(data):
+    """Previous UserProfile.from_mod1 parsing, fields only."""
+    data = re.sub(r"<\?xml.*?\?>", "", data).strip()
+    mod = ET.fromstring(f"<root>{data}</root>").find("mod")
+    return (
+        mod.find("s").text,
+        mod.find("l").text,
+        mod.find("b").text,
+        urllib.parse.unquote(mod.find("body").text),
+    )
+
+
+def fromstring_gprofile(data):
+    """Previous RoomProfile.from_xml parsing, fields only."""
+    data = re.sub(r"<\?xml.*?\?>", "", data).strip()
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError:
+        root = ET.fromstring(f"<root>{data}</root>")
+    gp = root if root.tag == "gp" else root.find(".//gp")
+    return (
+        urllib.parse.unquote(gp.find("title").text),
+        urllib.parse.unquote(gp.find("desc").text),
+    )
+
+
+def fromstring_msgbg(data):
+    """Previous MessageBackground.from_xml parsing, fields only."""
+    data = re.sub(r"<\?xml.*?\?>", "", data).strip()
+    root = ET.fromstring(data)
+    return root.get("bgc"), int(root.get("bgalp"))
+
+
+def mod1(body_size):
+    body = urllib.parse.quote("<p>" + "lorem ipsum dolor " * (body_size // 18) + "</p>")
+    return (
+        f'{PROLOG}\n<mod><s>F</s><b>1990-01-01</b><l c="US" lat="1.5" lon="2.5">'
+        f"Somewhere</l><body>{body}</body><d>1700000000</d></mod>"
+    )
+
+
+def gprofile(body_size):
+    desc = urllib.parse.quote("<b>rules</b> " * (body_size // 13))
+    return f"{PROLOG}\n<gp><title>Room%20title</title><desc>{desc}</desc></gp>"
+
+
+MSGBG = (
+    f'{PROLOG}\n<bgi align="tl" bgalp="50" bgc="ff00ff" useimg="1" '
+    'ialp="100" tile="0" isvid="0"/>'
+)
+
+
+def check():
+    for size in (100, 10_000):
+        p = UserProfile.from_mod1(mod1(size))
+        assert (p.gender, p.location, p.birthdate, p.body_html) == fromstring_mod1(
+            mod1(size)
+        )
+        assert p.premium_expiry == 1700000000 and p.country_code == "US"
+        r = RoomProfile.from_xml(gprofile(size))
+        assert (r.group_title, r.group_body_html) == fromstring_gprofile(gprofile(size))
+    b = MessageBackground.from_xml(MSGBG)
+    assert (b.bg_color, b.bg_alpha) == fromstring_msgbg(MSGBG)
+    # Prolog after whitespace and several top-level elements
+    assert UserProfile.from_mod1(f"\n  {mod1(10)}<extra/>").gender == "F"
+    assert RoomProfile.from_xml("<a/><gp><title>x</title></gp>").group_title == "x"
+    assert MessageBackground.from_xml("<html><bgi bgc='abc'/>").bg_color == "abc"
+
+
+def old_element(data, tag):
+    """Previous XML step: regex prolog strip, fromstring, wrapped retry, find."""
+    data = re.sub(r"<\?xml.*?\?>", "", data).strip()
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError:
+        root = ET.fromstring(f"<root>{data}</root>")
+    return root if root.tag == tag else root.find(f".//{tag}")
+
+
+def best(func, number, repeat=7):
+    """Fastest time per call over several runs, to damp machine noise."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    check()
+    docs = [("msgbg.xml", MSGBG, "bgi", MessageBackground.from_xml)]
+    for size in (200, 5_000, 100_000, 2_000_000):
+        docs.append((f"mod1.xml {size}", mod1(size), "mod", UserProfile.from_mod1))
+        docs.append(
+            (f"gprofile.xml {size}", gprofile(size), "gp", RoomProfile.from_xml)
+        )
+    # Fragments with several top-level elements made the old code parse twice
+    fragment = gprofile(100_000) + "<x/>"
+    docs.append(("gprofile fragment", fragment, "gp", RoomProfile.from_xml))
+
+    print(f"{'':<22} {'size':>9}   {'XML step: old':>14} {'new':>10}{'full parse':>18}")
+    for label, data, tag, parse in docs:
+        number = max(1, 500_000 // len(data))
+        t_old = best(lambda: old_element(data, tag), number)
+        t_new = best(lambda: _find_xml_element(data, tag), number)
+        t_full = best(lambda: parse(data), number)
+        print(
+            f"{label:<22} {len(data):>9}B  {t_old * 1e6:12.1f}us {t_new * 1e6:8.1f}us  "
+            f"x{t_old / t_new:<5.2f} {t_full * 1e6:10.1f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+"""
+Compares MessageHistory.search with the full-text index against the
+linear scan fallback on a full room history.
+
+    python benchmarks/bench_search.py
+"""
+
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chatango.message import MessageHistory, RoomMessage
+from chatango.user import UserManager
+
+HISTORY_SIZE = 3000
+QUERIES = ["hello", "stream tonight", '"who is live"', "zzqx"]
+
+
+class FakeRoom:
+    name = "benchmark"
+
+
+def random_word(rng):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 8)))
+
+
+def build(search):
+    rng = random.Random(1)
+    users = [UserManager.get_user(name=f"user{i}") for i in range(50)]
+    phrases = ["hello there", "stream tonight at nine", "who is live now"]
+    history = MessageHistory(maxlen=HISTORY_SIZE, search=search)
+    room = FakeRoom()
+    for i in range(HISTORY_SIZE):
+        words = [random_word(rng) for _ in range(rng.randint(3, 20))]
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), rng.choice(phrases))
+        msg = RoomMessage(rng.choice(users), room, str(i))
+        # Busy rooms get several messages per timestamp
+        msg.time = float(i // 4)
+        msg.body = " ".join(words)
+        history.append(msg.id, msg)
+    return history, users
+
+
+def main():
+    indexed, users = build(search=True)
+    linear, _ = build(search=False)
+    number = 200
+    for query in QUERIES:
+        for label, kwargs in [("", {}), (" user=", {"user": users[0]})]:
+            expected = [m.id for m in linear.search(query, **kwargs)]
+            assert [m.id for m in indexed.search(query, **kwargs)] == expected
+            t_index = timeit.timeit(
+                lambda: indexed.search(query, **kwargs), number=number
+            )
+            t_scan = timeit.timeit(
+                lambda: linear.search(query, **kwargs), number=number
+            )
+            print(
+                f"{query!r:<20}{label:<7} index {t_index / number * 1e6:9.1f}us  "
+                f"scan {t_scan / number * 1e6:9.1f}us  x{t_scan / t_index:.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
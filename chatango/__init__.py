@@ -1,10 +1,110 @@
-from .client import *
-from .room import *
-from .exceptions import *
-from .pm import *
-from .utils import *
-from .user import *
-from .message import *
-from .handler import *
+"""
+Submodules are imported on first attribute access, so importing the
+package itself stays cheap and each name only loads the modules it
+comes from.
+"""
+
+import importlib
+from typing import TYPE_CHECKING
 
 __version__ = "1.10.2"
+
+# Star-import order of the original eager __init__, later modules win.
+# http holds the network helpers the original utils module had.
+_modules = (
+    "client",
+    "room",
+    "exceptions",
+    "pm",
+    "http",
+    "utils",
+    "user",
+    "message",
+    "handler",
+    "archive",
+    "moderation",
+    "prefetch",
+)
+
+# fmt: off
+_exports = {
+    "archive": ["MessageArchive"],
+    "client": ["Client", "ConnectionListener"],
+    "connection": ["WebsocketConnection"],
+    "exceptions": ["AlreadyConnectedError", "BaseRoomError", "InvalidRoomNameError"],
+    "fetch": [
+        "ResourceCache", "ResourceStore", "fetch_resources", "resource_cache",
+        "upload_image",
+    ],
+    "handler": ["CommandHandler", "EventHandler", "TaskHandler"],
+    "hasher": ["Hasher"],
+    "http": [
+        "HostResolver", "PoolConfig", "ResumingSSLContext", "TokenManager",
+        "close_aiohttp_session", "configure_pool", "get_aiohttp_session",
+        "get_token", "multipart", "multipart_writer", "on_request_exception",
+        "pool_config", "prewarm_dns", "token_manager", "trace",
+    ],
+    "message": [
+        "Command", "Fonts", "Message", "MessageFlags", "MessageHistory",
+        "PMMessage", "RoomMessage", "SearchIndex", "message_cut",
+    ],
+    "moderation": ["ModerationAction", "ModerationExecutor", "ModerationReport"],
+    "pm": ["PM"],
+    "prefetch": ["ProfilePrefetcher"],
+    "resources": [
+        "MessageBackground", "PathProvider", "RoomProfile", "Styles", "UserProfile",
+    ],
+    "room": [
+        "BanList", "ParticipantList", "PendingQueue", "Room", "RoomFlags",
+        "RoomSnapshot",
+    ],
+    "user": [
+        "AdminFlags", "AnonymousUser", "Friend", "ModeratorFlags",
+        "RegisteredUser", "Session", "TemporaryUser", "User", "UserManager",
+        "get_anon_name",
+    ],
+    "utils": [
+        "HttpMetrics", "gen_uid", "get_server", "http_metrics", "public_attributes",
+        "resolve_servers", "specials", "tshashes", "tsweights",
+    ],
+}
+# fmt: on
+
+_lazy = {name: module for module, names in _exports.items() for name in names}
+
+__all__ = sorted(_lazy)
+
+
+def __getattr__(name):
+    module = _lazy.get(name)
+    if module is not None:
+        value = getattr(importlib.import_module(f".{module}", __name__), name)
+        globals()[name] = value
+        return value
+    if not name.startswith("_"):
+        # Anything else the eager star imports used to re-export
+        for module in reversed(_modules):
+            mod = importlib.import_module(f".{module}", __name__)
+            if name in vars(mod):
+                value = globals()[name] = vars(mod)[name]
+                return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
+
+
+if TYPE_CHECKING:
+    from .client import *
+    from .room import *
+    from .exceptions import *
+    from .pm import *
+    from .http import *
+    from .utils import *
+    from .user import *
+    from .message import *
+    from .handler import *
+    from .archive import *
+    from .moderation import *
+    from .prefetch import *
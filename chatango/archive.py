@@ -0,0 +1,293 @@
+import os
+import json
+import mmap
+import time
+import struct
+import asyncio
+import logging
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple, BinaryIO, TYPE_CHECKING
+
+from .message import Message, MessageFlags, MessageHistory, RoomMessage, _message_user
+
+if TYPE_CHECKING:
+    from .room import Room
+
+logger = logging.getLogger(__name__)
+
+
+class _RoomIndex:
+    """In-memory time index over one room archive file."""
+
+    def __init__(self, id_window: int):
+        self.entries: List[Tuple[float, int]] = []
+        # Ids of the newest messages, to skip history replayed after reconnects
+        self.ids: "OrderedDict[str, None]" = OrderedDict()
+        self.id_window = id_window
+        self.deleted: Set[str] = set()
+        self.end = 0
+
+    def add_id(self, msg_id: str):
+        self.ids[msg_id] = None
+        if len(self.ids) > self.id_window:
+            self.ids.popitem(last=False)
+
+
+class MessageArchive:
+    """
+    Append-only on-disk archive of room messages.
+
+    Add it as a listener on rooms (or pass it to Client) to record the
+    message, message_history, message_recovered, delete and deleteall
+    events. Each room is stored in its own file as a sequence of
+    length-prefixed records, and read back through mmap using a time
+    index built on first access.
+    Each record is flushed to the file as it is written, and fsynced in
+    batches of sync_every records, or sync_interval seconds after the
+    first record not yet synced, whichever comes first.
+
+    A record torn by a crash at the end of a file is truncated before the
+    next append. Corrupt records elsewhere are logged and skipped.
+    Duplicates are only detected among the newest id_window messages of
+    each room, which covers what the server replays on reconnect.
+    """
+
+    id_window = 10000
+
+    # payload length, message time, record kind
+    _header = struct.Struct("<IdB")
+    _MESSAGE = 0
+    _DELETE = 1
+
+    def __init__(self, directory: str, sync_every: int = 100, sync_interval=5.0):
+        self.directory = directory
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._files: Dict[str, BinaryIO] = dict()
+        self._indexes: Dict[str, _RoomIndex] = dict()
+        self._pending = 0
+        self._sync_timer: Optional[asyncio.Task] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"<MessageArchive {self.directory}>"
+
+    def _path(self, room_name: str) -> str:
+        return os.path.join(self.directory, f"{room_name}.log")
+
+    def _map(self, room_name: str) -> Optional[mmap.mmap]:
+        """Map the room file read-only, None if it is missing or empty."""
+        if f := self._files.get(room_name):
+            f.flush()
+        try:
+            with open(self._path(room_name), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def _index(self, room_name: str) -> _RoomIndex:
+        """Load or build the time index for a room."""
+        if index := self._indexes.get(room_name):
+            return index
+        index = self._indexes[room_name] = _RoomIndex(self.id_window)
+        mm = self._map(room_name)
+        if mm is None:
+            return index
+        with mm:
+            offset, size = 0, len(mm)
+            while offset + self._header.size <= size:
+                length, msg_time, kind = self._header.unpack_from(mm, offset)
+                start = offset + self._header.size
+                if start + length > size:
+                    # Torn write at the end of the file
+                    break
+                offset, record_offset = start + length, offset
+                try:
+                    record = json.loads(mm[start:offset])
+                    if kind == self._MESSAGE:
+                        msg_id = record["id"]
+                    elif kind == self._DELETE:
+                        deleted = record["ids"]
+                    else:
+                        raise ValueError(f"unknown record kind {kind}")
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(
+                        f"Skipping corrupt archive record in {room_name} "
+                        f"at {record_offset}: {e}"
+                    )
+                    continue
+                if kind == self._MESSAGE:
+                    index.entries.append((msg_time, record_offset))
+                    index.add_id(msg_id)
+                else:
+                    index.deleted.update(deleted)
+        index.entries.sort()
+        index.end = offset
+        return index
+
+    def _file(self, room_name: str, index: _RoomIndex) -> BinaryIO:
+        if f := self._files.get(room_name):
+            return f
+        f = open(self._path(room_name), "ab")
+        if f.tell() > index.end:
+            logger.warning(f"Truncating partial record in {room_name} archive")
+            f.truncate(index.end)
+            f.seek(index.end)
+        self._files[room_name] = f
+        return f
+
+    async def _append(self, room_name: str, kind: int, msg_time: float, record):
+        index = self._index(room_name)
+        payload = json.dumps(record, separators=(",", ":")).encode()
+        try:
+            f = self._file(room_name, index)
+            offset = f.tell()
+            f.write(self._header.pack(len(payload), msg_time, kind) + payload)
+            f.flush()
+        except OSError as e:
+            logger.error(f"Failed to write {room_name} archive: {e}")
+            return
+        index.end = offset + self._header.size + len(payload)
+        if kind == self._MESSAGE:
+            insort(index.entries, (msg_time, offset))
+            index.add_id(record["id"])
+        else:
+            index.deleted.update(record["ids"])
+
+        self._pending += 1
+        if self._pending >= self.sync_every:
+            await self.sync()
+        elif self._sync_timer is None:
+            self._sync_timer = asyncio.ensure_future(self._sync_later())
+
+    async def _sync_later(self):
+        await asyncio.sleep(self.sync_interval)
+        await self.sync()
+
+    async def sync(self):
+        """Flush buffered records and fsync them to disk."""
+        self._pending = 0
+        timer, self._sync_timer = self._sync_timer, None
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        for room_name, f in list(self._files.items()):
+            try:
+                f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to sync {room_name} archive: {e}")
+
+    def close(self):
+        """Flush, fsync and close all open room files."""
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        for f in self._files.values():
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError as e:
+                logger.error(f"Failed to sync archive on close: {e}")
+            f.close()
+        self._files.clear()
+        self._pending = 0
+
+    async def archive_message(self, room: "Room", msg: RoomMessage):
+        """Append a message unless it is already archived."""
+        if msg.id in self._index(room.name).ids:
+            return
+        user = msg.user
+        record = {
+            "id": msg.id,
+            "name": "" if user.isanon else user.showname,
+            "tname": user.showname if user.istemp else "",
+            "aid": msg.short_cookie,
+            "ec": msg.encoded_cookie,
+            "ip": msg.ip,
+            "flags": int(msg.flags),
+            "raw": msg.raw,
+        }
+        await self._append(room.name, self._MESSAGE, msg.time, record)
+
+    async def archive_deleted(self, room: "Room", msg_ids: List[str]):
+        """Append a deletion record for message ids."""
+        await self._append(room.name, self._DELETE, time.time(), {"ids": msg_ids})
+
+    def messages(
+        self,
+        room: "Room",
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> List[RoomMessage]:
+        """
+        Read archived messages for a room ordered by time.
+        @param since: only messages with time at or after this timestamp
+        @param until: only messages with time before this timestamp
+        @param limit: keep only the newest messages up to this count
+        """
+        index = self._index(room.name)
+        lo = 0 if since is None else bisect_left(index.entries, (since,))
+        hi = (
+            len(index.entries)
+            if until is None
+            else bisect_left(index.entries, (until,))
+        )
+        if limit is not None:
+            lo = max(lo, hi - limit)
+        if lo >= hi:
+            return []
+
+        mm = self._map(room.name)
+        if mm is None:
+            return []
+        result = []
+        with mm:
+            for msg_time, offset in index.entries[lo:hi]:
+                length, _, _ = self._header.unpack_from(mm, offset)
+                start = offset + self._header.size
+                record = json.loads(mm[start : start + length])
+
+                user = _message_user(
+                    record["name"], record["tname"], record["aid"], record["raw"]
+                )
+                msg = RoomMessage(user, room, record["id"])
+                msg.time = msg_time
+                msg.short_cookie = record["aid"]
+                msg.encoded_cookie = record["ec"]
+                msg.ip = record["ip"]
+                msg.raw = record["raw"]
+                msg.body = Message.clean_body_text(record["raw"])
+                msg.flags = MessageFlags(record["flags"])
+                msg.deleted = msg.id in index.deleted
+                result.append(msg)
+        return result
+
+    def load_history(self, room: "Room", maxlen: int = 3000) -> MessageHistory:
+        """Build a MessageHistory for a room from its newest archived messages."""
+        history = MessageHistory(maxlen=maxlen, search=room.history_search)
+        for msg in self.messages(room, limit=maxlen or None):
+            history.append(msg.id, msg)
+        return history
+
+    #
+    # Room listener callbacks
+    #
+
+    async def on_message(self, room: "Room", msg: RoomMessage):
+        await self.archive_message(room, msg)
+
+    async def on_message_history(self, room: "Room", msg: RoomMessage):
+        await self.archive_message(room, msg)
+
+    async def on_message_recovered(self, room: "Room", msg: RoomMessage):
+        await self.archive_message(room, msg)
+
+    async def on_delete(self, room: "Room", msg_id: str):
+        await self.archive_deleted(room, [msg_id])
+
+    async def on_deleteall(self, room: "Room", msg_ids: List[str]):
+        await self.archive_deleted(room, list(msg_ids))
@@ -2,9 +2,12 @@ import asyncio
 import logging
 from typing import Dict, List, Optional
 
+from .archive import MessageArchive
 from .handler import TaskHandler
 from .pm import PM
+from .prefetch import ProfilePrefetcher
 from .room import Room
+from .http import prewarm_dns
 from .utils import public_attributes
 
 logger = logging.getLogger(__name__)
@@ -22,6 +25,9 @@ class ConnectionListener:
 
 
 class Client(TaskHandler):
+    # Resolve the servers of the initial rooms while joining them
+    prewarm = True
+
     def __init__(
         self,
         username: str = "",
@@ -30,6 +36,8 @@ class Client(TaskHandler):
         pm=False,
         room_class=Room,
         pm_class=PM,
+        archive: Optional[MessageArchive] = None,
+        prefetcher: Optional[ProfilePrefetcher] = None,
     ):
         super().__init__()
         self._room_class = room_class
@@ -43,6 +51,8 @@ class Client(TaskHandler):
         self.initial_rooms_connected: List[str] = []
         self.username = username
         self.password = password
+        self.archive = archive
+        self.prefetcher = prefetcher
 
     def __dir__(self):
         return public_attributes(self)
@@ -54,6 +64,10 @@ class Client(TaskHandler):
             logger.error("No rooms or PM to join. Exiting.")
             return
 
+        if self.prewarm and self.initial_rooms:
+            # Runs alongside the joins, which share its lookups in flight
+            self.add_task(prewarm_dns(self.initial_rooms))
+
         if self.use_pm:
             self.join_pm()
 
@@ -66,6 +80,10 @@ class Client(TaskHandler):
             await self.task_loop
         else:
             await self.complete_tasks()
+        if self.archive is not None:
+            self.archive.close()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
         self.running = False
 
     def join_pm(self):
@@ -99,6 +117,10 @@ class Client(TaskHandler):
         room = self._room_class(room_name)
         room.add_listener(self)
         room.add_listener(ConnectionListener(self))
+        if self.archive is not None:
+            room.use_archive(self.archive)
+        if self.prefetcher is not None:
+            room.add_listener(self.prefetcher)
         self.rooms[room_name] = room
         await room.listen(self.username, self.password, reconnect=True)
         self.rooms.pop(room_name, None)
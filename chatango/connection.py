@@ -1,10 +1,13 @@
+import ssl
+import time
 import asyncio
 import aiohttp
 import logging
 import socket
 from typing import Optional
 from .handler import CommandHandler
-from .utils import get_aiohttp_session
+from .http import ResumingSSLContext, get_aiohttp_session
+from .utils import http_metrics
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +22,7 @@ class WebsocketConnection(CommandHandler):
         self._connection: Optional[aiohttp.ClientWebSocketResponse] = None
         self._recv_task: Optional[asyncio.Task] = None
         self._ping_task: Optional[asyncio.Task] = None
+        self._ssl_object: Optional[ssl.SSLObject] = None
 
     @property
     def connected(self):
@@ -30,9 +34,11 @@ class WebsocketConnection(CommandHandler):
 
     async def _connect(self, url: str):
         try:
+            started = time.monotonic()
             self._connection = await get_aiohttp_session().ws_connect(
                 url, origin="http://st.chatango.com"
             )
+            self._record_handshake(url, time.monotonic() - started)
             self._connected = True
             self._recv_task = asyncio.create_task(self._do_recv())
             self._ping_task = asyncio.create_task(self._do_ping())
@@ -123,8 +129,21 @@ class WebsocketConnection(CommandHandler):
             logger.warning(f"Unexpected error connecting to {url}: {e}")
             raise ConnectionError from e
 
+    def _record_handshake(self, url: str, elapsed: float):
+        host = url.split("//")[-1].split(":")[0]
+        http_metrics.record(host, "handshake", elapsed)
+        self._ssl_object = self._connection.get_extra_info("ssl_object")
+        if self._ssl_object is not None:
+            resumed = self._ssl_object.session_reused
+            http_metrics.incr(host, "tls_resumed" if resumed else "tls_full")
+        logger.debug(f"WebSocket handshake with {host} took {elapsed * 1000:.1f}ms")
+
     async def _disconnect(self):
         self._connected = False
+        ssl_object = self._ssl_object
+        context = ssl_object and ssl_object.context
+        if isinstance(context, ResumingSSLContext):
+            context.save_session(ssl_object)
         if self._ping_task:
             self._ping_task.cancel()
             try:
@@ -0,0 +1,609 @@
+import time
+import copy
+import json
+import socket
+import sqlite3
+import asyncio
+import logging
+import weakref
+import dataclasses
+import urllib.parse
+import aiohttp
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+from .http import get_aiohttp_session, multipart_writer
+from .resources import Fetchable, PathProvider
+
+T = TypeVar("T")
+logger = logging.getLogger(__name__)
+
+# Maximum concurrent GET requests per resource host and event loop
+max_per_host = 8
+_host_limits: "weakref.WeakKeyDictionary[Any, Dict[str, Any]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _host_limit(url: str):
+    """Semaphore bounding concurrent requests to the host of url."""
+    limits = _host_limits.setdefault(asyncio.get_running_loop(), dict())
+    host = urllib.parse.urlsplit(url).netloc
+    if host not in limits:
+        limits[host] = asyncio.Semaphore(max_per_host)
+    return limits[host]
+
+
+async def _get_response(
+    url: str, headers: Optional[Dict[str, str]] = None
+) -> Tuple[int, Optional[str], Mapping[str, str]]:
+    """
+    Unified HTTP GET handler with robust exception and binary handling.
+    @return: (status, text, response headers). Status is 0 on network
+    errors, and text is None unless a 200 response was decoded.
+    """
+    try:
+        async with (
+            _host_limit(url),
+            get_aiohttp_session().get(url, headers=headers) as resp,
+        ):
+            if resp.status == 200:
+                # chatango sometimes returns a small image instead of XML for msgbg.xml
+                content_type = resp.headers.get("Content-Type", "").lower()
+                if "image" in content_type:
+                    logger.debug(f"Received image instead of text from {url}")
+                    return resp.status, None, resp.headers
+                try:
+                    return resp.status, await resp.text(), resp.headers
+                except (UnicodeDecodeError, aiohttp.ClientPayloadError) as e:
+                    logger.debug(f"Failed to decode text from {url}: {e}")
+                    return resp.status, None, resp.headers
+            elif resp.status != 304:
+                logger.warning(f"HTTP error {resp.status} fetching {url}")
+            return resp.status, None, resp.headers
+
+    except (aiohttp.ClientResponseError, aiohttp.ClientConnectorError) as e:
+        logger.warning(f"Aiohttp error fetching {url}: {e}")
+    except (socket.gaierror, ConnectionResetError, asyncio.TimeoutError) as e:
+        logger.warning(f"Network error fetching {url}: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error fetching {url}: {e}")
+    return 0, None, {}
+
+
+async def _get_data(url: str) -> Optional[str]:
+    """Body of a successful HTTP GET, None on any error."""
+    return (await _get_response(url))[1]
+
+
+async def _post_data(url: str, data: Dict[str, str]) -> Optional[str]:
+    """Unified HTTP POST handler with robust exception handling."""
+    try:
+        async with get_aiohttp_session().post(url, data=data) as resp:
+            if resp.status == 200:
+                return await resp.text()
+            else:
+                logger.warning(f"HTTP error {resp.status} posting to {url}")
+
+    except (aiohttp.ClientResponseError, aiohttp.ClientConnectorError) as e:
+        logger.warning(f"Aiohttp error posting to {url}: {e}")
+    except (socket.gaierror, ConnectionResetError, asyncio.TimeoutError) as e:
+        logger.warning(f"Network error posting to {url}: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error posting to {url}: {e}")
+    return None
+
+
+# Concurrent image uploads per event loop, and attempts per upload
+max_uploads = 2
+upload_attempts = 3
+upload_retry_delay = 1.0
+# Uploads have no total time limit, only connect and per-read stall limits
+upload_connect_timeout = 10.0
+upload_read_timeout = 60.0
+_upload_limits: "weakref.WeakKeyDictionary[Any, Any]" = weakref.WeakKeyDictionary()
+
+
+def _upload_limit():
+    loop = asyncio.get_running_loop()
+    if loop not in _upload_limits:
+        _upload_limits[loop] = asyncio.Semaphore(max_uploads)
+    return _upload_limits[loop]
+
+
+async def upload_image(
+    handle: str, password: str, path: str, return_url: bool = False
+) -> Optional[str]:
+    """
+    Uploads an image file to the account of handle, streaming it from disk.
+    Network errors and server errors are retried up to upload_attempts
+    times with exponential backoff.
+    @param return_url: return the image URL instead of the img tag
+    @return: img tag to put in a message (or URL), None on failure
+    """
+    url = "https://chatango.com/uploadimg"
+    headers = {"Origin": "https://st.chatango.com"}
+    fields = {"u": handle, "p": password}
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=upload_connect_timeout, sock_read=upload_read_timeout
+    )
+    async with _upload_limit():
+        for attempt in range(upload_attempts):
+            if attempt:
+                await asyncio.sleep(upload_retry_delay * 2 ** (attempt - 1))
+            try:
+                f = open(path, "rb")
+            except OSError as e:
+                logger.error(f"Failed to read image {path}: {e}")
+                return None
+            try:
+                with f:
+                    files = {"filedata": {"filename": path, "file": f}}
+                    async with get_aiohttp_session().post(
+                        url,
+                        data=multipart_writer(fields, files),
+                        headers=headers,
+                        timeout=timeout,
+                    ) as resp:
+                        status, response = resp.status, await resp.text()
+            except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Network error uploading {path}: {e}")
+                continue
+            if status >= 500:
+                logger.warning(f"HTTP error {status} uploading {path}")
+                continue
+            if status == 200 and response.startswith("success:"):
+                image_id = response.split(":", 1)[1].strip()
+                if return_url:
+                    return PathProvider.get_image_url(handle, image_id)
+                return f"img{image_id}"
+            logger.warning(f"Image upload of {path} rejected: {status} {response!r}")
+            return None
+    logger.error(f"Giving up uploading {path} after {upload_attempts} attempts")
+    return None
+
+
+async def fetch_resources(
+    handle: str, resource_types: List[Type[Fetchable]]
+) -> List[Any]:
+    """Fetches multiple resources in parallel for a given handle."""
+    if not handle:
+        return []
+
+    tasks = [res_type.fetch(handle) for res_type in resource_types]
+    return list(await asyncio.gather(*tasks))
+
+
+@dataclass
+class _CacheEntry:
+    obj: Any
+    expires: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def validators(self) -> Dict[str, str]:
+        """Conditional request headers to revalidate this entry."""
+        headers = dict()
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResourceStore:
+    """
+    SQLite file holding parsed resources across restarts.
+
+    Used by ResourceCache as a second level behind its in-memory entries.
+    Rows are read lazily on a memory miss and written when a fetch succeeds
+    or revalidates, with commits batched every commit_every writes. Rows
+    not refreshed for max_age seconds are dropped when the file is opened
+    and by compact().
+    """
+
+    commit_every = 100
+
+    def __init__(self, path: str, max_age: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self._db = None
+        self._pending = 0
+
+    def __repr__(self):
+        return f"<ResourceStore {self.path}>"
+
+    def _execute(self, sql: str, params: tuple = ()):
+        try:
+            if self._db is None:
+                self._db = sqlite3.connect(self.path)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS resources ("
+                    "kind TEXT NOT NULL, handle TEXT NOT NULL, data TEXT NOT NULL, "
+                    "fetched_at REAL NOT NULL, etag TEXT, last_modified TEXT, "
+                    "PRIMARY KEY (kind, handle))"
+                )
+                self._db.execute(
+                    "DELETE FROM resources WHERE fetched_at < ?",
+                    (time.time() - self.max_age,),
+                )
+                self._db.commit()
+            return self._db.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.error(f"Resource store {self.path} error: {e}")
+            return None
+
+    def _written(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def load(
+        self, kind: Type[T], handle: str
+    ) -> Optional[Tuple[T, float, Optional[str], Optional[str]]]:
+        """
+        Read a stored resource.
+        @return: (object, fetched_at timestamp, etag, last_modified) or None
+        """
+        cursor = self._execute(
+            "SELECT data, fetched_at, etag, last_modified FROM resources "
+            "WHERE kind = ? AND handle = ?",
+            (kind.__name__, handle),
+        )
+        row = cursor.fetchone() if cursor is not None else None
+        if row is None:
+            return None
+        data, fetched_at, etag, last_modified = row
+        try:
+            names = {f.name for f in dataclasses.fields(kind)}
+            obj = kind(**{k: v for k, v in json.loads(data).items() if k in names})
+        except (ValueError, TypeError) as e:
+            logger.debug(f"Discarding stored {kind.__name__} of {handle}: {e}")
+            return None
+        return obj, fetched_at, etag, last_modified
+
+    def fetched_at(self, kind: Type, handle: str) -> Optional[float]:
+        """Fetch timestamp of a stored resource, None if it is not stored."""
+        cursor = self._execute(
+            "SELECT fetched_at FROM resources WHERE kind = ? AND handle = ?",
+            (kind.__name__, handle),
+        )
+        row = cursor.fetchone() if cursor is not None else None
+        return row[0] if row is not None else None
+
+    def save(
+        self,
+        kind: Type[T],
+        handle: str,
+        obj: T,
+        fetched_at: float,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ):
+        data = json.dumps(dataclasses.asdict(obj), separators=(",", ":"))
+        self._execute(
+            "INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?)",
+            (kind.__name__, handle, data, fetched_at, etag, last_modified),
+        )
+        self._written()
+
+    def touch(self, kind: Type, handle: str, fetched_at: float):
+        """Update the fetch time of a revalidated resource."""
+        self._execute(
+            "UPDATE resources SET fetched_at = ? WHERE kind = ? AND handle = ?",
+            (fetched_at, kind.__name__, handle),
+        )
+        self._written()
+
+    def delete(self, handle: str, kinds: Optional[Iterable[Type]] = None):
+        if kinds is None:
+            self._execute("DELETE FROM resources WHERE handle = ?", (handle,))
+        else:
+            for kind in kinds:
+                self._execute(
+                    "DELETE FROM resources WHERE kind = ? AND handle = ?",
+                    (kind.__name__, handle),
+                )
+        self._written()
+
+    def compact(self, max_age: Optional[float] = None) -> int:
+        """
+        Drop rows not refreshed for max_age seconds and reclaim file space.
+        @return: number of rows removed
+        """
+        max_age = self.max_age if max_age is None else max_age
+        cursor = self._execute(
+            "DELETE FROM resources WHERE fetched_at < ?", (time.time() - max_age,)
+        )
+        self.commit()
+        self._execute("VACUUM")
+        return cursor.rowcount if cursor is not None else 0
+
+    def commit(self):
+        self._pending = 0
+        if self._db is not None:
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+        self._pending = 0
+
+
+class ResourceCache:
+    """
+    TTL and size bounded LRU cache of fetched resources.
+
+    Entries are keyed by (resource type name, lowercase handle). Successful
+    fetches, including missing resources, live for ttl seconds. Failed
+    ones (kept as default objects) live for negative_ttl seconds. Callers
+    get a copy of the cached object, so editing e.g. user.styles in place
+    does not leak into the cache.
+
+    Expired entries that carry an ETag or Last-Modified validator are kept
+    until evicted, so the next fetch can revalidate them with a
+    conditional GET and reuse the parsed object on 304 Not Modified.
+
+    With a ResourceStore attached, successful fetches are also persisted
+    and loaded back on a memory miss, so a restarted bot starts warm.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 4096,
+        ttl: float = 300.0,
+        negative_ttl: float = 30.0,
+        store: Optional[ResourceStore] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.store = store
+        self._entries: "OrderedDict[Tuple[str, str], _CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.coalesced = 0
+        self.revalidated = 0
+        self.loaded = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"<ResourceCache size:{len(self)} hits:{self.hits} misses:{self.misses}>"
+
+    @staticmethod
+    def _key(kind: Type, handle: str) -> Tuple[str, str]:
+        return kind.__name__, handle.lower()
+
+    def _lookup(self, kind: Type, handle: str) -> Tuple[Tuple[str, str], Any]:
+        """Memory entry of a resource, loaded from the store on a miss."""
+        key = self._key(kind, handle)
+        entry = self._entries.get(key)
+        if entry is None and self.store is not None:
+            stored = self.store.load(kind, key[1])
+            if stored is not None:
+                obj, fetched_at, etag, last_modified = stored
+                age = max(0.0, time.time() - fetched_at)
+                expires = time.monotonic() + self.ttl - age
+                entry = _CacheEntry(obj, expires, etag, last_modified)
+                self._insert(key, entry)
+                self.loaded += 1
+        return key, entry
+
+    def _insert(self, key: Tuple[str, str], entry: _CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, kind: Type[T], handle: str) -> Optional[T]:
+        """Cached copy of a resource, None if missing or expired."""
+        key, entry = self._lookup(kind, handle)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires <= time.monotonic():
+            if not entry.validators:
+                del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.copy(entry.obj)
+
+    def contains(self, kind: Type, handle: str) -> bool:
+        """
+        Whether a fresh entry is cached in memory or in the store. Nothing is
+        loaded from the store, and LRU order and metrics are left untouched.
+        """
+        key = self._key(kind, handle)
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry.expires > time.monotonic()
+        if self.store is not None:
+            fetched_at = self.store.fetched_at(kind, key[1])
+            return fetched_at is not None and time.time() - fetched_at < self.ttl
+        return False
+
+    def validators(self, kind: Type, handle: str) -> Dict[str, str]:
+        """Conditional request headers for a cached resource, fresh or stale."""
+        _, entry = self._lookup(kind, handle)
+        return entry.validators if entry is not None else dict()
+
+    def put(
+        self,
+        kind: Type[T],
+        handle: str,
+        obj: T,
+        ttl: Optional[float] = None,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        persist: bool = True,
+    ):
+        """
+        Store a copy of a resource.
+        @param ttl: lifetime in seconds, defaults to self.ttl
+        @param etag: ETag response header, for later revalidation
+        @param last_modified: Last-Modified response header
+        @param persist: also write it to the store, if any
+        """
+        key = self._key(kind, handle)
+        if persist and self.store is not None:
+            self.store.save(kind, key[1], obj, time.time(), etag, last_modified)
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._insert(key, _CacheEntry(copy.copy(obj), expires, etag, last_modified))
+
+    def revalidate(
+        self, kind: Type[T], handle: str, ttl: Optional[float] = None
+    ) -> Optional[T]:
+        """
+        Mark a cached resource as fresh again after a 304 Not Modified.
+        @return: copy of the cached object, None if it was evicted meanwhile
+        """
+        key = self._key(kind, handle)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        entry.expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries.move_to_end(key)
+        self.revalidated += 1
+        if self.store is not None:
+            self.store.touch(kind, key[1], time.time())
+        return copy.copy(entry.obj)
+
+    def invalidate(self, handle: str, kinds: Optional[Iterable[Type]] = None) -> int:
+        """
+        Drop cached resources of a handle.
+        @param kinds: resource types to drop, all of them if None
+        @return: number of entries removed
+        """
+        handle = handle.lower()
+        if kinds is None:
+            keys = [key for key in self._entries if key[1] == handle]
+        else:
+            keys = [self._key(kind, handle) for kind in kinds]
+        removed = 0
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                removed += 1
+        self.invalidations += removed
+        if self.store is not None:
+            self.store.delete(handle, kinds)
+        return removed
+
+    def clear(self):
+        """Drop all in-memory entries. The store, if any, is left untouched."""
+        self._entries.clear()
+
+    def close(self):
+        """Close the attached store."""
+        if self.store is not None:
+            self.store.close()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "coalesced": self.coalesced,
+            "revalidated": self.revalidated,
+            "loaded": self.loaded,
+        }
+
+
+resource_cache = ResourceCache()
+
+
+async def _load_resource(
+    cls: Type[T], handle: str, url: str, parse: Callable[[str], T]
+) -> T:
+    headers = resource_cache.validators(cls, handle)
+    if getattr(cls, "cache_buster", True):
+        url = f"{url}?cb={time.time()}"
+    status, data, response_headers = await _get_response(url, headers or None)
+    if status == 304 and headers:
+        obj = resource_cache.revalidate(cls, handle)
+        if obj is not None:
+            return obj
+        # Evicted while the request was in flight
+        status, data, response_headers = await _get_response(url)
+    if data:
+        obj = parse(data)
+        resource_cache.put(
+            cls,
+            handle,
+            obj,
+            etag=response_headers.get("ETag"),
+            last_modified=response_headers.get("Last-Modified"),
+        )
+    elif status in (200, 404):
+        # The user has no such resource (or only an image placeholder)
+        obj = cls()
+        resource_cache.put(cls, handle, obj)
+    else:
+        obj = cls()
+        resource_cache.put(
+            cls, handle, obj, ttl=resource_cache.negative_ttl, persist=False
+        )
+    return obj
+
+
+_inflight: Dict[str, Any] = dict()
+
+
+async def _fetch_resource(
+    cls: Type[T], handle: str, resource: str, parse: Callable[[str], T]
+) -> T:
+    """
+    Fetch and parse a resource file of handle through resource_cache.
+    Concurrent fetches of the same url share a single request. A ?cb=
+    cache-buster is appended unless cls.cache_buster is False, for
+    resources whose host revalidates conditional requests correctly.
+    """
+    cached = resource_cache.get(cls, handle)
+    if cached is not None:
+        return cached
+    url = PathProvider.get_resource_url(handle, resource)
+    task = _inflight.get(url)
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        resource_cache.coalesced += 1
+    else:
+        task = asyncio.ensure_future(_load_resource(cls, handle, url, parse))
+        _inflight[url] = task
+
+        def _done(t, url=url):
+            if _inflight.get(url) is t:
+                del _inflight[url]
+
+        task.add_done_callback(_done)
+    # Shielded so a cancelled caller doesn't cancel the fetch for the others
+    return copy.copy(await asyncio.shield(task))
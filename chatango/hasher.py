@@ -6,9 +6,14 @@ the group name.  Some groups use this method
 instead of the weights based method.  Check
 first using the hash lookup then fallback to
 weights.
+
+The algorithm is plain MD5 over the latin-1 bytes of the input, so
+Hasher uses hashlib.md5 and only falls back to the pure Python
+PyHasher for strings with characters that do not fit in a byte.
 """
 
 import ctypes
+import hashlib
 
 
 FFFFVAL = ctypes.c_int32(0xFFFFFFFF).value
@@ -56,7 +61,7 @@ def nott(val):
     return ~(val & mask)
 
 
-class Hasher:
+class PyHasher:
     def __init__(self):
         self.block_size = 64
         self.state = [1732584193, 4023233417, 2562383102, 271733878]
@@ -291,3 +296,31 @@ class Hasher:
     def hash(self, input):
         message = self.update(input).finalize()
         return "".join(["{:02x}".format(num) for num in message])
+
+
+class Hasher:
+    def __init__(self):
+        self._chunks = []
+
+    def update(self, message, length=None):
+        if length:
+            message = message[:length]
+        self._chunks.append(message)
+        return self
+
+    def finalize(self):
+        md5 = hashlib.md5(usedforsecurity=False)
+        try:
+            for chunk in self._chunks:
+                md5.update(
+                    chunk.encode("latin-1") if isinstance(chunk, str) else bytes(chunk)
+                )
+        except (UnicodeEncodeError, ValueError):
+            hasher = PyHasher()
+            for chunk in self._chunks:
+                hasher.update(chunk)
+            return hasher.finalize()
+        return list(md5.digest())
+
+    def hash(self, input):
+        return bytes(self.update(input).finalize()).hex()
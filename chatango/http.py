@@ -0,0 +1,751 @@
+import os
+import ssl
+import hmac
+import json
+import time
+import random
+import string
+import socket
+import asyncio
+import hashlib
+import logging
+import weakref
+import mimetypes
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .utils import http_metrics, resolve_servers
+
+logger = logging.getLogger(__name__)
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    Client SSL context that offers the last TLS session of a host when
+    connecting to it again, so reconnects can skip the full handshake.
+    Sessions are taken from connections still open to the host, or saved
+    with save_session before a connection is dropped.
+    """
+
+    def __init__(self, protocol=None):
+        super().__init__()
+        self._sessions: Dict[str, ssl.SSLSession] = dict()
+        self._live: Dict[str, "weakref.ref[ssl.SSLObject]"] = dict()
+
+    @classmethod
+    def create_default(cls) -> "ResumingSSLContext":
+        """
+        Client context with the settings of ssl.create_default_context on
+        the running Python, such as its X.509 verify flags and SSLKEYLOGFILE,
+        and the default CA certificates loaded.
+        """
+        template = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context = cls(ssl.PROTOCOL_TLS_CLIENT)
+        context.options = template.options
+        context.verify_flags = template.verify_flags
+        context.check_hostname = template.check_hostname
+        context.verify_mode = template.verify_mode
+        if getattr(template, "keylog_filename", None):
+            context.keylog_filename = template.keylog_filename
+        context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+        return context
+
+    def wrap_bio(
+        self, incoming, outgoing, server_side=False, server_hostname=None, session=None
+    ):
+        if session is None and not server_side and server_hostname:
+            session = self.get_session(server_hostname)
+        ssl_object = super().wrap_bio(
+            incoming, outgoing, server_side, server_hostname, session
+        )
+        if not server_side and server_hostname:
+            self._live[server_hostname] = weakref.ref(ssl_object)
+        return ssl_object
+
+    def save_session(self, ssl_object: ssl.SSLObject):
+        """Keep the session of a connection for the next one to its host."""
+        session = ssl_object.session
+        if session is not None and ssl_object.server_hostname:
+            self._sessions[ssl_object.server_hostname] = session
+
+    def get_session(self, host: str) -> Optional[ssl.SSLSession]:
+        ref = self._live.get(host)
+        ssl_object = ref and ref()
+        if ssl_object is not None:
+            self.save_session(ssl_object)
+        session = self._sessions.get(host)
+        if session is not None and time.time() >= session.time + session.timeout:
+            del self._sessions[host]
+            return None
+        return session
+
+
+class HostResolver(AbstractResolver):
+    """
+    Caching DNS resolver of the shared session, which is its only DNS cache:
+    the connector is created with aiohttp's own cache turned off.
+
+    Answers are kept for ttl seconds (forever if None), and the last answer
+    for a host is still used if refreshing it fails. Concurrent lookups of
+    the same host share one query. prewarm resolves many hosts ahead of
+    connecting to them.
+    """
+
+    def __init__(self, ttl: Optional[float] = 10):
+        self.ttl = ttl
+        self._resolver: Optional[AbstractResolver] = None
+        self._cache: Dict[Tuple[str, int], Tuple[float, List]] = dict()
+        self._inflight: Dict[Tuple[str, int], asyncio.Future] = dict()
+
+    async def resolve(self, host: str, port: int = 0, family=socket.AF_INET):
+        key = (host, family)
+        cached = self._cache.get(key)
+        if cached is not None and (self.ttl is None or time.monotonic() < cached[0]):
+            return [{**addr, "port": port} for addr in cached[1]]
+        lookup = self._inflight.get(key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._lookup(host, port, family))
+            self._inflight[key] = lookup
+            lookup.add_done_callback(lambda f: self._lookup_done(key, f))
+        try:
+            addrs = await asyncio.shield(lookup)
+        except OSError as e:
+            if cached is None:
+                raise
+            logger.warning(f"DNS refresh failed for {host}, using last answer: {e}")
+            addrs = cached[1]
+        return [{**addr, "port": port} for addr in addrs]
+
+    async def _lookup(self, host: str, port: int, family) -> List:
+        if self._resolver is None:
+            self._resolver = aiohttp.DefaultResolver()
+        started = time.monotonic()
+        addrs = await self._resolver.resolve(host, port, family)
+        # Only actual queries count as DNS latency, cache hits don't
+        http_metrics.record(host, "dns", time.monotonic() - started)
+        self._cache[(host, family)] = (time.monotonic() + (self.ttl or 0), addrs)
+        return addrs
+
+    def _lookup_done(self, key: Tuple[str, int], lookup: asyncio.Future):
+        self._inflight.pop(key, None)
+        # Waiters may all have been cancelled, don't leave the error unretrieved
+        if not lookup.cancelled():
+            lookup.exception()
+
+    async def prewarm(
+        self,
+        hosts: Iterable[str],
+        port: int = 443,
+        family=socket.AF_UNSPEC,
+        timeout: float = 5.0,
+    ) -> Dict[str, float]:
+        """
+        Resolves hosts concurrently and caches the answers.
+        @return: resolution time per host, failed hosts left out
+        """
+
+        async def timed(host):
+            started = time.monotonic()
+            try:
+                await self.resolve(host, port, family)
+            except OSError as e:
+                logger.warning(f"DNS prewarm failed for {host}: {e}")
+                return host, None
+            return host, time.monotonic() - started
+
+        tasks = [asyncio.ensure_future(timed(host)) for host in set(hosts)]
+        if not tasks:
+            return dict()
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        timings = dict()
+        for task in done:
+            host, elapsed = task.result()
+            if elapsed is not None:
+                timings[host] = elapsed
+        if pending:
+            logger.warning(f"DNS prewarm timed out for {len(pending)} hosts")
+        return timings
+
+    async def close(self):
+        if self._resolver is not None:
+            await self._resolver.close()
+            self._resolver = None
+
+
+async def on_request_exception(session, context, params):
+    logging.getLogger("aiohttp.client").debug(f"on request exception: <{params}>")
+    http_metrics.incr(getattr(context, "host", params.url.host), "errors")
+
+
+async def on_request_start(session, context, params):
+    context.host = params.url.host
+    context.start = time.monotonic()
+    http_metrics.incr(context.host, "requests")
+
+
+async def on_request_end(session, context, params):
+    http_metrics.record(context.host, "ttfb", time.monotonic() - context.start)
+
+
+async def on_connection_queued_start(session, context, params):
+    context.queued = time.monotonic()
+
+
+async def on_connection_queued_end(session, context, params):
+    http_metrics.record(context.host, "queued", time.monotonic() - context.queued)
+
+
+async def on_connection_create_start(session, context, params):
+    context.connect = time.monotonic()
+    context.dns = 0.0
+
+
+async def on_connection_create_end(session, context, params):
+    elapsed = time.monotonic() - context.connect - context.dns
+    http_metrics.record(context.host, "connect", elapsed)
+    http_metrics.incr(context.host, "connections")
+
+
+async def on_connection_reuseconn(session, context, params):
+    http_metrics.incr(context.host, "reused")
+
+
+async def on_dns_resolvehost_start(session, context, params):
+    context.dns_start = time.monotonic()
+
+
+async def on_dns_resolvehost_end(session, context, params):
+    # Only taken out of the connect time, HostResolver records DNS latency
+    context.dns = time.monotonic() - context.dns_start
+
+
+def trace():
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(on_connection_queued_end)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    return trace_config
+
+
+@dataclass
+class PoolConfig:
+    """
+    Connection pool settings of the shared aiohttp session.
+
+    limit bounds open connections overall and limit_per_host per host,
+    0 meaning no limit. Websocket connections to chat servers hold a pool
+    slot for their whole lifetime, so limit should leave room for resource
+    fetches on top of the rooms joined. Cached DNS answers live for
+    ttl_dns_cache seconds, None caching them forever. happy_eyeballs_delay
+    is the head start each address gets before the next one is tried, None
+    disabling Happy Eyeballs.
+    """
+
+    limit: int = 100
+    limit_per_host: int = 0
+    keepalive_timeout: float = 15.0
+    use_dns_cache: bool = True
+    ttl_dns_cache: Optional[int] = 10
+    happy_eyeballs_delay: Optional[float] = 0.25
+    interleave: Optional[int] = None
+    total_timeout: float = 30.0
+    connect_timeout: float = 10.0
+
+
+pool_config = PoolConfig()
+
+
+def configure_pool(**settings) -> PoolConfig:
+    """
+    Change pool_config settings. They apply to sessions created afterwards,
+    see close_aiohttp_session.
+    @raise TypeError: on an unknown setting
+    """
+    for name, value in settings.items():
+        if not hasattr(pool_config, name):
+            raise TypeError(f"Unknown pool setting {name!r}")
+        setattr(pool_config, name, value)
+    if _aiohttp_session is not None:
+        logger.warning("Pool settings apply after close_aiohttp_session()")
+    return pool_config
+
+
+_aiohttp_session = None
+_resolver = None
+_ssl_context = None
+
+
+def get_ssl_context():
+    """
+    Shared SSL context for Chatango hosts, created on first use.
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        # Chatango uses legacy TLS configurations on some server ports (e.g. PM 8081)
+        # We must lower the security level to allow negotiation with these hosts.
+        ssl_context = ResumingSSLContext.create_default()
+
+        # 0x4 is the underlying OpenSSL value for OP_LEGACY_SERVER_CONNECT
+        # This allows connecting to servers that don't support RFC 5746 (renegotiation)
+        ssl_context.options |= 0x4
+
+        # Lower security level to 1 to allow older ciphers/hashes used by Chatango
+        try:
+            ssl_context.set_ciphers("DEFAULT@SECLEVEL=1")
+        except ssl.SSLError:
+            # Fallback if SECLEVEL is not supported by the system's OpenSSL
+            pass
+        _ssl_context = ssl_context
+    return _ssl_context
+
+
+def get_aiohttp_session():
+    """
+    Shared aiohttp session, created on first network use with pool_config.
+    """
+    global _aiohttp_session, _resolver
+    if _aiohttp_session is None:
+        _resolver = HostResolver(
+            ttl=pool_config.ttl_dns_cache if pool_config.use_dns_cache else 0
+        )
+        connector = aiohttp.TCPConnector(
+            ssl=get_ssl_context(),
+            resolver=_resolver,
+            limit=pool_config.limit,
+            limit_per_host=pool_config.limit_per_host,
+            keepalive_timeout=pool_config.keepalive_timeout,
+            # Answers are cached by the resolver, see HostResolver
+            use_dns_cache=False,
+            happy_eyeballs_delay=pool_config.happy_eyeballs_delay,
+            interleave=pool_config.interleave,
+        )
+
+        timeout = aiohttp.ClientTimeout(
+            total=pool_config.total_timeout, connect=pool_config.connect_timeout
+        )
+        _aiohttp_session = aiohttp.ClientSession(
+            connector=connector, timeout=timeout, trace_configs=[trace()]
+        )
+    return _aiohttp_session
+
+
+async def close_aiohttp_session():
+    """Close the shared session, the next get_aiohttp_session creates a new one."""
+    global _aiohttp_session, _resolver
+    session, _aiohttp_session = _aiohttp_session, None
+    resolver, _resolver = _resolver, None
+    if session is not None:
+        await session.close()
+    if resolver is not None:
+        await resolver.close()
+
+
+async def prewarm_dns(rooms: Iterable[str], port: int = 8081) -> Dict[str, float]:
+    """
+    Resolve the servers of rooms ahead of joining them, so the connections
+    start from cached DNS answers. Resolution times are also recorded in
+    http_metrics.
+    @return: resolution time per server host
+    """
+    get_aiohttp_session()
+    return await _resolver.prewarm(set(resolve_servers(rooms).values()), port)
+
+
+class TokenManager:
+    """
+    Caches Chatango auth tokens per account.
+
+    Logins go through a cookie-less session that shares the connection pool
+    of get_aiohttp_session(), and concurrent requests for one account share
+    a single login. A cached token is only handed out for the password it
+    was obtained with, checked against a salted HMAC of it. Tokens are
+    renewed in the background refresh_margin seconds before they expire
+    (or on the next request, with auto_refresh off), so connects don't wait
+    for a DENIED to re-authenticate. With a path, tokens and salted PBKDF2
+    password hashes are also kept in a JSON file readable only by the
+    owner, so restarts skip the login. PBKDF2 runs in a worker thread after
+    the login, and writes to the file are batched save_delay seconds apart.
+    """
+
+    login_url = "http://chatango.com/login"
+    cookie_name = "auth.chatango.com"
+    # Used when the auth cookie has no expiry
+    token_ttl = 24 * 3600.0
+    refresh_margin = 3600.0
+    auto_refresh = True
+    min_refresh_interval = 60.0
+    hash_iterations = 100_000
+    save_delay = 1.0
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        # name -> (token, expires, salt, PBKDF2 hash), the last two in hex,
+        # the hash only computed (after the login) with a path to store it in
+        self._tokens: Dict[str, Tuple[str, float, str, Optional[str]]] = dict()
+        # name -> HMAC of the password the token was obtained with
+        self._checked: Dict[str, bytes] = dict()
+        self._save_handle = None
+        self._hash_tasks = set()
+        self._locks: Dict[str, Any] = dict()
+        self._refresh_tasks: Dict[str, Any] = dict()
+        self._loaded = False
+        self._session = None
+        self.hits = 0
+        self.logins = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def __repr__(self):
+        return f"<TokenManager accounts:{len(self._tokens)} logins:{self.logins}>"
+
+    async def get(self, user_name: str, password: str) -> Optional[str]:
+        """
+        Token for an account, logging in if none is cached or it is due
+        for renewal. If the login fails, a cached token that has not yet
+        expired is still returned.
+        """
+        name = str(user_name).lower()
+        password = str(password)
+        self._load()
+        if self._fresh(name) and self._checked_match(name, password):
+            self.hits += 1
+            self._schedule_refresh(name, password)
+            return self._tokens[name][0]
+
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            if self._fresh(name) and await self._matches(name, password):
+                self.hits += 1
+                self._schedule_refresh(name, password)
+                return self._tokens[name][0]
+            if await self._renew(name, password):
+                return self._tokens[name][0]
+            cached = self._tokens.get(name)
+            if (
+                cached
+                and cached[1] > time.time()
+                and await self._matches(name, password)
+            ):
+                return cached[0]
+            return None
+
+    async def _renew(self, name: str, password: str) -> bool:
+        """Log in and store the new token. Call with the account lock held."""
+        token, expires = await self._login(name, password)
+        if not token:
+            return False
+        salt = os.urandom(16)
+        entry = (token, expires, salt.hex(), None)
+        self._tokens[name] = entry
+        self._checked[name] = self._digest(password, salt)
+        if self.path:
+            task = asyncio.ensure_future(self._store(name, password, entry))
+            self._hash_tasks.add(task)
+            task.add_done_callback(self._hash_tasks.discard)
+        self._schedule_refresh(name, password, replace=True)
+        return True
+
+    async def _store(self, name: str, password: str, entry: Tuple):
+        """Hash the password in a worker thread, then save the token with it."""
+        salt = bytes.fromhex(entry[2])
+        stored_hash = await asyncio.to_thread(self._hash, password, salt)
+        if self._tokens.get(name) is entry:
+            self._tokens[name] = (*entry[:3], stored_hash.hex())
+            self._save()
+
+    def _schedule_refresh(self, name: str, password: str, replace: bool = False):
+        if not self.auto_refresh:
+            return
+        task = self._refresh_tasks.get(name)
+        if task is not None and not task.done():
+            if not replace:
+                return
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._refresh_tasks[name] = asyncio.ensure_future(
+            self._refresh_later(name, password)
+        )
+
+    async def _refresh_later(self, name: str, password: str):
+        """Renews a token refresh_margin seconds before it expires."""
+        cached = self._tokens.get(name)
+        if cached is None:
+            return
+        # Tokens shorter lived than refresh_margin are not renewed in a loop
+        delay = cached[1] - self.refresh_margin - time.time()
+        await asyncio.sleep(max(delay, self.min_refresh_interval))
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            if self._tokens.get(name) is not cached:
+                # Renewed or invalidated meanwhile
+                return
+            self.refreshes += 1
+            if not await self._renew(name, password):
+                logger.warning(f"Background token refresh for {name} failed")
+
+    @staticmethod
+    def _digest(password: str, salt: bytes) -> bytes:
+        return hmac.new(salt, password.encode(), hashlib.sha256).digest()
+
+    def _hash(self, password: str, salt: bytes) -> bytes:
+        return hashlib.pbkdf2_hmac(
+            "sha256", password.encode(), salt, self.hash_iterations
+        )
+
+    def _checked_match(self, name: str, password: str) -> bool:
+        """Fast check of password against the HMAC, False if there is none yet."""
+        cached = self._tokens.get(name)
+        checked = self._checked.get(name)
+        if cached is None or checked is None:
+            return False
+        digest = self._digest(password, bytes.fromhex(cached[2]))
+        return hmac.compare_digest(digest, checked)
+
+    async def _matches(self, name: str, password: str) -> bool:
+        """
+        Whether password is the one the cached token was obtained with.
+        Tokens loaded from the store are checked once against their PBKDF2
+        hash, in a worker thread.
+        """
+        cached = self._tokens.get(name)
+        if cached is None:
+            return False
+        if name in self._checked:
+            return self._checked_match(name, password)
+        if not cached[3]:
+            return False
+        salt = bytes.fromhex(cached[2])
+        stored_hash = await asyncio.to_thread(self._hash, password, salt)
+        if self._tokens.get(name) is not cached:
+            return False
+        if hmac.compare_digest(stored_hash.hex(), cached[3]):
+            self._checked[name] = self._digest(password, salt)
+            return True
+        return False
+
+    def invalidate(self, user_name: str):
+        """Forget the token of an account, e.g. after the server denied it."""
+        name = str(user_name).lower()
+        self._checked.pop(name, None)
+        task = self._refresh_tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+        if self._tokens.pop(name, None) is not None:
+            self._save()
+
+    def _fresh(self, name: str) -> bool:
+        cached = self._tokens.get(name)
+        return cached is not None and cached[1] - self.refresh_margin > time.time()
+
+    def _login_session(self):
+        shared = get_aiohttp_session()
+        if (
+            self._session is None
+            or self._session.closed
+            or self._session.connector is not shared.connector
+        ):
+            # Don't keep auth cookies of one account around for the next
+            self._session = aiohttp.ClientSession(
+                connector=shared.connector,
+                connector_owner=False,
+                cookie_jar=aiohttp.DummyCookieJar(),
+                timeout=shared.timeout,
+            )
+        return self._session
+
+    async def _login(self, name: str, password: str) -> Tuple[Optional[str], float]:
+        payload = {
+            "user_id": name,
+            "password": str(password),
+            "storecookie": "on",
+            "checkerrors": "yes",
+        }
+        self.logins += 1
+        try:
+            async with self._login_session().post(self.login_url, data=payload) as resp:
+                cookie = resp.cookies.get(self.cookie_name)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Login request for {name} failed: {e}")
+            cookie = None
+        if cookie is None or not cookie.value:
+            self.failures += 1
+            return None, 0.0
+        return cookie.value, self._expiry(cookie)
+
+    def _expiry(self, cookie) -> float:
+        """Expiry timestamp from the max-age or expires attribute of a cookie."""
+        try:
+            if cookie["max-age"]:
+                return time.time() + float(cookie["max-age"])
+            if cookie["expires"]:
+                return parsedate_to_datetime(cookie["expires"]).timestamp()
+        except (TypeError, ValueError, IndexError):
+            pass
+        return time.time() + self.token_ttl
+
+    def _load(self):
+        if self._loaded or not self.path:
+            return
+        self._loaded = True
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+            now = time.time()
+            for name, entry in stored.items():
+                # Entries without a password hash can't be checked, skip them
+                if entry["expires"] > now and entry.get("hash"):
+                    self._tokens.setdefault(
+                        name,
+                        (
+                            entry["token"],
+                            entry["expires"],
+                            entry["salt"],
+                            entry["hash"],
+                        ),
+                    )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Ignoring unreadable token store {self.path}: {e}")
+
+    def _save(self):
+        """Write the store save_delay seconds from now, with later changes."""
+        if not self.path or self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write()
+            return
+        self._save_handle = loop.call_later(self.save_delay, self._write)
+
+    def _write(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if not self.path:
+            return
+        stored = {
+            name: {"token": token, "expires": expires, "salt": salt, "hash": digest}
+            for name, (token, expires, salt, digest) in self._tokens.items()
+            if digest
+        }
+        tmp = f"{self.path}.tmp"
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(stored, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.error(f"Failed to write token store {self.path}: {e}")
+
+    async def close(self):
+        """
+        Stop background refreshes, write pending changes to the store and
+        close the login session. The shared connection pool stays open.
+        """
+        for task in self._refresh_tasks.values():
+            task.cancel()
+        self._refresh_tasks.clear()
+        if self._hash_tasks:
+            await asyncio.gather(*self._hash_tasks)
+        if self._save_handle is not None:
+            self._write()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+token_manager = TokenManager()
+
+
+async def get_token(user_name, passwd):
+    """Auth token for an account, cached by token_manager."""
+    return await token_manager.get(user_name, passwd)
+
+
+def multipart(data, files, boundary=None):
+    lineas = []
+
+    def escape_quote(s):
+        return s.replace('"', '\\"')
+
+    if boundary == None:
+        boundary = "".join(
+            random.choice(string.digits + string.ascii_letters) for x in range(30)
+        )
+    for nombre, valor in data.items():
+        lineas.extend(
+            (
+                "--%s" % boundary,
+                'Content-Disposition: form-data; name="%s"' % nombre,
+                "",
+                str(valor),
+            )
+        )
+    for nombre, valor in files.items():
+        filename = valor["filename"]
+        if "mimetype" in valor:
+            mimetype = valor["mimetype"]
+        else:
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        lineas.extend(
+            (
+                "--%s" % boundary,
+                'Content-Disposition: form-data; name="%s"; '
+                'filename="%s"' % (escape_quote(nombre), escape_quote(filename)),
+                "Content-Type: %s" % mimetype,
+                "",
+                valor["content"],
+            )
+        )
+    lineas.extend(
+        (
+            "--%s--" % boundary,
+            "",
+        )
+    )
+    body = "\r\n".join(lineas)
+    headers = {
+        "Content-Type": "multipart/form-data; boundary=%s" % boundary,
+        "Content-Length": str(len(body)),
+    }
+    return body, headers
+
+
+def multipart_writer(data, files):
+    """
+    Streaming counterpart of multipart, as an aiohttp.MultipartWriter.
+    @param data: form field names to values
+    @param files: field names to dicts with filename, an optional mimetype,
+    and either content (str or bytes) or file, an open binary file that is
+    read in chunks while the request is sent
+    """
+    writer = aiohttp.MultipartWriter("form-data")
+    for name, value in data.items():
+        part = writer.append(str(value))
+        part.set_content_disposition("form-data", name=name)
+    for name, value in files.items():
+        filename = value["filename"]
+        mimetype = (
+            value.get("mimetype")
+            or mimetypes.guess_type(filename)[0]
+            or "application/octet-stream"
+        )
+        content = value["file"] if "file" in value else value["content"]
+        part = writer.append(content, {"Content-Type": mimetype})
+        part.set_content_disposition(
+            "form-data", name=name, filename=os.path.basename(filename)
+        )
+    return writer
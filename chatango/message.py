@@ -2,8 +2,10 @@ import re
 import time
 import enum
 import html
-from collections import OrderedDict
-from typing import Union, Any, TYPE_CHECKING
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Union, Any, TYPE_CHECKING
 
 from .utils import public_attributes
 from .user import User, UserManager
@@ -125,21 +127,26 @@ class RoomMessage(Message):
         return f'<RoomMessage {self.room.name} {self.user.name} {"deleted " if self.deleted else ""}"{self.body}">'
 
 
-async def _process(room, args):
-    """Process message"""
-    _time = float(args[0]) - room.session.correction_time
-    name, tname, aid, encoded_cookie, msgid, ip, flags = args[1:8]
-    body = ":".join(args[9:])
-
+def _message_user(name: str, tname: str, aid: str, body: str) -> User:
+    """Resolve the sender of a room message from its protocol fields"""
     if name:
         # Registered User
-        user = UserManager.get_user(name=name)
+        return UserManager.get_user(name=name)
     else:
         # Anonymous or Temporary User
         # Extract Display Number (<nNNNN/> tag)
         n_match = re.search(r"<n(\d{4})/?\s*>", body)
         ts_short = n_match.group(1) if n_match else "3452"
-        user = UserManager.get_user(name=tname, aid=aid, ts_short=ts_short)
+        return UserManager.get_user(name=tname, aid=aid, ts_short=ts_short)
+
+
+async def _process(room, args):
+    """Process message"""
+    _time = float(args[0]) - room.session.correction_time
+    name, tname, aid, encoded_cookie, msgid, ip, flags = args[1:8]
+    body = ":".join(args[9:])
+
+    user = _message_user(name, tname, aid, body)
 
     msg = RoomMessage(user, room, msgid)
     msg.time = float(_time)
@@ -191,26 +198,205 @@ def message_cut(message, lenth):
     return [message[x : x + lenth] for x in range(0, len(message), lenth)]
 
 
-class MessageHistory(OrderedDict):
-    """Combined dict + deque for message storage based on OrderedDict.
+class SearchIndex:
+    """Inverted index from body tokens to message ids.
 
-    Supports bounded size like deque(maxlen). Iterates over values
-    (messages) rather than keys. Supports negative integer indexing
-    for access to newest/oldest items.
+    Queries are a string where bare words must all be present (AND) and
+    double quoted parts must appear as an exact phrase, or an iterable
+    of terms where any term containing several words is a phrase.
+    """
+
+    _token_re = re.compile(r"\w+")
+    _phrase_re = re.compile(r'"([^"]*)"|(\S+)')
+
+    def __init__(self):
+        self._postings: Dict[str, Set[str]] = dict()
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls._token_re.findall(text.lower())
+
+    @classmethod
+    def parse_query(cls, terms: Union[str, Iterable[str]]) -> List[List[str]]:
+        """Splits a query into token groups, groups longer than one are phrases."""
+        if isinstance(terms, str):
+            terms = [a or b for a, b in cls._phrase_re.findall(terms)]
+        groups = [cls.tokenize(term) for term in terms]
+        return [group for group in groups if group]
+
+    @classmethod
+    def matches(cls, text: str, groups: List[List[str]]) -> bool:
+        """Checks a text against parsed query groups without using the index."""
+        tokens = cls.tokenize(text)
+        token_set = set(tokens)
+        joined = f" {' '.join(tokens)} "
+        for group in groups:
+            if len(group) == 1:
+                if group[0] not in token_set:
+                    return False
+            elif f" {' '.join(group)} " not in joined:
+                return False
+        return True
+
+    def add(self, key: str, text: str) -> None:
+        for token in set(self.tokenize(text)):
+            self._postings.setdefault(token, set()).add(key)
+
+    def discard(self, key: str, text: str) -> None:
+        for token in set(self.tokenize(text)):
+            if keys := self._postings.get(token):
+                keys.discard(key)
+                if not keys:
+                    del self._postings[token]
+
+    def candidates(self, groups: List[List[str]]) -> Set[str]:
+        """Ids of messages containing every token of the query."""
+        tokens = {token for group in groups for token in group}
+        postings = sorted(
+            (self._postings.get(token, set()) for token in tokens), key=len
+        )
+        if not postings:
+            return set()
+        result = set(postings[0])
+        for keys in postings[1:]:
+            result &= keys
+            if not result:
+                break
+        return result
+
+    def clear(self) -> None:
+        self._postings.clear()
+
+
+class MessageHistory(dict):
+    """Combined dict + deque for message storage.
+
+    Messages are stored in a dict keyed by message id for constant time
+    lookup, while a deque of keys keeps the positional order. Supports
+    bounded size like deque(maxlen). Iterates over values (messages)
+    rather than keys. Integer indexing and slicing read the key deque
+    directly, so access near either end (history[-1], history[-10:])
+    does not copy the history.
 
     When full, appending a new key evicts the oldest entry (left side).
     appendleft() discards the incoming message when full.
+
+    Secondary indexes by user, encoded cookie and IP are kept up to date
+    on every insert and removal, see by_user(), by_cookie() and by_ip().
+    With search=True a SearchIndex over message bodies is kept as well,
+    otherwise search() falls back to a linear scan.
+
+    A time column sorted by message time is kept apart from the
+    positional order, since history prepended with appendleft() is not
+    guaranteed to be older than what is already stored. between() and
+    since() binary search it.
     """
 
-    def __init__(self, *args, maxlen: int = 20000, **kwargs):
+    _indexed_fields = ("user", "encoded_cookie", "ip")
+
+    def __init__(self, *args, maxlen: int = 20000, search: bool = False, **kwargs):
+        super().__init__()
         self.maxlen = maxlen
-        super().__init__(*args, **kwargs)
+        self._keys = deque()
+        self._indexes = {field: dict() for field in self._indexed_fields}
+        self._search: Optional[SearchIndex] = SearchIndex() if search else None
+        self._times: List[float] = []
+        self._time_keys: List[str] = []
+        self.update(*args, **kwargs)
+
+    @staticmethod
+    def _discard(keys: deque, key: str) -> None:
+        """Remove a key from a deque, checking the ends first."""
+        if keys[0] == key:
+            keys.popleft()
+        elif keys[-1] == key:
+            keys.pop()
+        else:
+            keys.remove(key)
+
+    def _insort_key(self, keys: deque, key: str, msg_time: float) -> None:
+        """Insert a key after the last key whose message is not newer."""
+        i = len(keys)
+        while i and getattr(dict.__getitem__(self, keys[i - 1]), "time", 0) > msg_time:
+            i -= 1
+        keys.insert(i, key)
+
+    def _index(
+        self, key: str, value: Any, left: bool = False, ordered: bool = False
+    ) -> None:
+        for field, index in self._indexes.items():
+            if field_value := getattr(value, field, None):
+                keys = index.setdefault(field_value, deque())
+                if ordered:
+                    self._insort_key(keys, key, value.time)
+                elif left:
+                    keys.appendleft(key)
+                else:
+                    keys.append(key)
+        if self._search is not None and (body := getattr(value, "body", None)):
+            self._search.add(key, body)
+        if (msg_time := getattr(value, "time", None)) is not None:
+            # Messages with equal times keep their positional order
+            bisect = bisect_left if left else bisect_right
+            i = bisect(self._times, msg_time)
+            self._times.insert(i, msg_time)
+            self._time_keys.insert(i, key)
+
+    def _unindex(self, key: str, value: Any) -> None:
+        for field, index in self._indexes.items():
+            field_value = getattr(value, field, None)
+            if keys := index.get(field_value):
+                self._discard(keys, key)
+                if not keys:
+                    del index[field_value]
+        if self._search is not None and (body := getattr(value, "body", None)):
+            self._search.discard(key, body)
+        if (msg_time := getattr(value, "time", None)) is not None:
+            i = bisect_left(self._times, msg_time)
+            while i < len(self._times) and self._times[i] == msg_time:
+                if self._time_keys[i] == key:
+                    del self._times[i]
+                    del self._time_keys[i]
+                    break
+                i += 1
+
+    def _add(self, key: str, value: Any, left: bool = False) -> None:
+        """Insert a new key at either end of the order."""
+        super().__setitem__(key, value)
+        if left:
+            self._keys.appendleft(key)
+        else:
+            self._keys.append(key)
+        self._index(key, value, left)
+
+    def _remove(self, key: str) -> Any:
+        """Remove a key from the dict and the order, returning its value."""
+        value = super().pop(key)
+        self._discard(self._keys, key)
+        self._unindex(key, value)
+        return value
+
+    def _evict(self) -> None:
+        """Drop the oldest entry."""
+        self._remove(self._keys[0])
 
     def __setitem__(self, key: str, value: Any) -> None:
         """Set item, evicting oldest if at capacity and key is new."""
-        if self.maxlen > 0 and key not in self and len(self) >= self.maxlen:
-            self.popitem(last=False)
-        super().__setitem__(key, value)
+        if key in self:
+            old = super().__getitem__(key)
+            if old is not value:
+                self._unindex(key, old)
+                self._index(key, value)
+            super().__setitem__(key, value)
+            return
+        if self.maxlen > 0 and len(self) >= self.maxlen:
+            self._evict()
+        self._add(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._remove(key)
 
     def append(self, key: str, value: Any) -> None:
         """Add item to the right (newest). Evicts oldest if full."""
@@ -218,34 +404,247 @@ class MessageHistory(OrderedDict):
 
     def appendleft(self, key: str, value: Any) -> bool:
         """Add item to the left (oldest). Returns False if discarded."""
-        if self.maxlen > 0 and len(self) >= self.maxlen and key not in self:
+        if key in self:
+            self._remove(key)
+        elif self.maxlen > 0 and len(self) >= self.maxlen:
             return False
-        super().__setitem__(key, value)
-        self.move_to_end(key, last=False)
+        self._add(key, value, left=True)
         return True
 
-    def last(self) -> Any:
-        """Return the most recent message."""
-        it = reversed(self.values())
-        return next(it, None)
+    def insort(self, key: str, value: Any) -> None:
+        """
+        Add item after the newest stored message not newer than it, for
+        messages that arrive late. Evicts oldest if full.
+        """
+        if key in self:
+            self[key] = value
+            return
+        if self.maxlen > 0 and len(self) >= self.maxlen:
+            self._evict()
+        super().__setitem__(key, value)
+        self._insort_key(self._keys, key, value.time)
+        self._index(key, value, ordered=True)
+
+    @property
+    def newest_time(self) -> Optional[float]:
+        """Time of the newest message, None if empty."""
+        return self._times[-1] if self._times else None
+
+    def last(self, n: Optional[int] = None) -> Any:
+        """
+        Return the most recent message, or a list of the n most recent
+        messages ordered oldest to newest.
+        """
+        if n is None:
+            return super().__getitem__(self._keys[-1]) if self._keys else None
+        if n <= 0:
+            return []
+        return self[-n:]
+
+    def _lookup(self, field: str, value: Any) -> List[Any]:
+        keys = self._indexes[field].get(value, ())
+        return [dict.__getitem__(self, k) for k in keys]
+
+    def by_user(self, user: User) -> List[Any]:
+        """Messages sent by a user, ordered oldest to newest."""
+        return self._lookup("user", user)
+
+    def by_cookie(self, encoded_cookie: str) -> List[Any]:
+        """Messages sent with an encoded cookie, ordered oldest to newest."""
+        return self._lookup("encoded_cookie", encoded_cookie)
+
+    def by_ip(self, ip: str) -> List[Any]:
+        """Messages sent from an IP, ordered oldest to newest."""
+        return self._lookup("ip", ip)
+
+    def ids_by_user(self, user: User) -> List[str]:
+        """Message ids sent by a user, ordered oldest to newest."""
+        return list(self._indexes["user"].get(user, ()))
+
+    def last_by_user(self, user: User) -> Any:
+        """Return the most recent message sent by a user."""
+        keys = self._indexes["user"].get(user)
+        return dict.__getitem__(self, keys[-1]) if keys else None
+
+    def _time_position(self, key: str, msg_time: float) -> int:
+        """Position of a stored key in the time column."""
+        i = bisect_left(self._times, msg_time)
+        while self._time_keys[i] != key:
+            i += 1
+        return i
+
+    def _time_range(self, start: Optional[float], end: Optional[float]) -> range:
+        lo = 0 if start is None else bisect_left(self._times, start)
+        hi = len(self._times) if end is None else bisect_left(self._times, end)
+        return range(lo, max(lo, hi))
+
+    def between(self, start: float, end: float) -> List[Any]:
+        """Messages with start <= time < end, ordered by time."""
+        return [
+            dict.__getitem__(self, self._time_keys[i])
+            for i in self._time_range(start, end)
+        ]
+
+    def since(self, start: float) -> List[Any]:
+        """Messages with time at or after start, ordered by time."""
+        return [
+            dict.__getitem__(self, self._time_keys[i])
+            for i in self._time_range(start, None)
+        ]
+
+    def count_between(self, start: float, end: float) -> int:
+        """Number of messages with start <= time < end."""
+        return len(self._time_range(start, end))
+
+    def count_since(self, start: float) -> int:
+        """Number of messages with time at or after start."""
+        return len(self._time_range(start, None))
+
+    @property
+    def searchable(self) -> bool:
+        return self._search is not None
+
+    def search(
+        self,
+        terms: Union[str, Iterable[str]],
+        user: Optional[User] = None,
+        since: Optional[float] = None,
+        limit: Optional[int] = 20,
+    ) -> List[Any]:
+        """
+        Find messages whose body matches all terms, newest first. Messages
+        with equal times are ordered as in the time column, so the index
+        and the linear scan return the same results.
+        @param terms: query string, quoted parts are phrases
+        @param user: only messages sent by this user
+        @param since: only messages with time at or after this timestamp
+        @param limit: maximum number of results, None for all
+        """
+        groups = SearchIndex.parse_query(terms)
+        if not groups or (limit is not None and limit <= 0):
+            return []
+
+        if self._search is None:
+            results = []
+            first = self._time_range(since, None).start
+            for i in range(len(self._time_keys) - 1, first - 1, -1):
+                msg = dict.__getitem__(self, self._time_keys[i])
+                if (user is None or msg.user == user) and SearchIndex.matches(
+                    msg.body, groups
+                ):
+                    results.append(msg)
+                    if limit is not None and len(results) >= limit:
+                        break
+            return results
+
+        keys = self._search.candidates(groups)
+        if user is not None:
+            keys &= set(self._indexes["user"].get(user, ()))
+        has_phrase = any(len(group) > 1 for group in groups)
+        found = []
+        for key in keys:
+            msg = dict.__getitem__(self, key)
+            if since is not None and msg.time < since:
+                continue
+            if has_phrase and not SearchIndex.matches(msg.body, groups):
+                continue
+            found.append((self._time_position(key, msg.time), msg))
+        if limit is None:
+            found.sort(key=lambda item: item[0], reverse=True)
+        else:
+            found = heapq.nlargest(limit, found, key=lambda item: item[0])
+        return [msg for _, msg in found]
 
     def __getitem__(self, key):
         if isinstance(key, int):
-            return list(self.values())[key]
+            return super().__getitem__(self._keys[key])
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self._keys))
+            return [
+                dict.__getitem__(self, self._keys[i]) for i in range(start, stop, step)
+            ]
         return super().__getitem__(key)
 
     def __iter__(self):
-        return iter(self.values())
+        return (dict.__getitem__(self, k) for k in self._keys)
 
     def __reversed__(self):
-        return reversed(self.values())
+        return (dict.__getitem__(self, k) for k in reversed(self._keys))
 
-    def copy(self):
-        new = MessageHistory(maxlen=self.maxlen)
-        for key, value in self.items():
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return [(k, dict.__getitem__(self, k)) for k in self._keys]
+
+    def pop(self, key, *default):
+        if key in self:
+            return self._remove(key)
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def popitem(self, last: bool = True):
+        if not self._keys:
+            raise KeyError("popitem(): history is empty")
+        key = self._keys[-1] if last else self._keys[0]
+        return key, self._remove(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self._keys.clear()
+        for index in self._indexes.values():
+            index.clear()
+        if self._search is not None:
+            self._search.clear()
+        self._times.clear()
+        self._time_keys.clear()
+
+    def move_to_end(self, key: str, last: bool = True) -> None:
+        value = self._remove(key)
+        self._add(key, value, left=not last)
+
+    def __eq__(self, other):
+        if isinstance(other, MessageHistory):
+            return self.items() == other.items()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.items()!r}, maxlen={self.maxlen})"
+
+    def __reduce__(self):
+        return (
+            self.__class__._from_items,
+            (self.maxlen, self.items(), self.searchable),
+        )
+
+    @classmethod
+    def _from_items(cls, maxlen: int, items, search: bool = False) -> "MessageHistory":
+        new = cls(maxlen=maxlen, search=search)
+        for key, value in items:
             new[key] = value
         return new
 
+    def copy(self):
+        return self._from_items(self.maxlen, self.items(), self.searchable)
+
     def __copy__(self):
         return self.copy()
 
@@ -255,7 +654,11 @@ class MessageHistory(OrderedDict):
         return new
 
     def __ror__(self, other):
-        new = MessageHistory(maxlen=self.maxlen)
+        new = MessageHistory(maxlen=self.maxlen, search=self.searchable)
         new.update(other)
-        new.update(self)
+        new.update(self.items())
         return new
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union, TYPE_CHECKING
+
+from .user import User, UserManager, ModeratorFlags
+
+if TYPE_CHECKING:
+    from .room import Room
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ModerationAction:
+    """A single command sent by ModerationExecutor."""
+
+    command: str
+    target: User
+    count: int = 1
+    duration: float = 0.0
+    error: Optional[str] = None
+    response: Any = field(default=None, repr=False)
+    exception: Optional[Exception] = field(default=None, repr=False)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class ModerationReport:
+    """Outcome of a ModerationExecutor run."""
+
+    actions: List[ModerationAction] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def completed(self) -> int:
+        return sum(1 for a in self.actions if a.ok)
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for a in self.actions if not a.ok)
+
+    @property
+    def deleted(self) -> int:
+        """Number of messages covered by successful delete commands."""
+        return sum(
+            a.count
+            for a in self.actions
+            if a.ok and a.command in ("delmsg", "delallmsg")
+        )
+
+    @property
+    def banned(self) -> int:
+        return sum(1 for a in self.actions if a.ok and a.command == "block")
+
+
+class ModerationExecutor:
+    """
+    Deletes and bans many users at once in a room.
+
+    Message ids for each target come from the room history indexes, and
+    are sent in delallmsg batches of at most batch_size ids (delmsg for a
+    single id). When banning, a block command follows each target's
+    deletes. Commands are paced at least interval seconds apart, which
+    defaults to the room rate limit unless the bot may send without
+    limitations. command_kwargs are passed to every send_command call, e.g.
+    wait_for_response.
+
+    A run stops at the first command that fails, and the report still
+    lists what was sent up to then.
+    """
+
+    batch_size = 50
+    min_interval = 0.25
+
+    def __init__(
+        self,
+        room: "Room",
+        interval: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        command_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        self.room = room
+        self.interval = interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.command_kwargs = command_kwargs or dict()
+
+    def _interval(self) -> float:
+        if self.interval is not None:
+            return self.interval
+        mod_flags = self.room._mods.get(self.room.user)
+        unlimited = mod_flags and ModeratorFlags.NO_SENDING_LIMITATIONS in mod_flags
+        rate_limit = self.room._rate_limit
+        if rate_limit and not unlimited:
+            return max(self.min_interval, float(rate_limit))
+        return self.min_interval
+
+    def plan(
+        self, users: Iterable[Union[User, str]], delete: bool = True, ban: bool = False
+    ) -> List[Tuple[str, tuple, User, int]]:
+        """
+        Builds the commands to send as (command, args, target, message count).
+        """
+        history = self.room.history
+        commands = []
+        for user in users:
+            if isinstance(user, str):
+                user = UserManager.get_user(name=user)
+            msgids = history.ids_by_user(user)
+            if delete:
+                for i in range(0, len(msgids), self.batch_size):
+                    batch = tuple(msgids[i : i + self.batch_size])
+                    command = "delmsg" if len(batch) == 1 else "delallmsg"
+                    commands.append((command, batch, user, len(batch)))
+            if ban and msgids and user not in self.room._banlist:
+                msg = history.last_by_user(user)
+                name = "" if user.isanon else user.name
+                commands.append(("block", (msg.encoded_cookie, msg.ip, name), user, 1))
+        return commands
+
+    async def run(
+        self, users: Iterable[Union[User, str]], delete: bool = True, ban: bool = False
+    ) -> ModerationReport:
+        """
+        Deletes the messages of users, and bans them if ban is set.
+        Stops early if the room connection is lost.
+        """
+        report = ModerationReport()
+        if self.room.get_level(self.room.user) == 0:
+            logger.error(f"Moderation in {self.room.name} requires moderator level")
+            return report
+
+        interval = self._interval()
+        started = next_at = time.monotonic()
+        for command, args, target, count in self.plan(users, delete=delete, ban=ban):
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent_at = time.monotonic()
+            next_at = sent_at + interval
+            action = ModerationAction(command, target, count)
+            try:
+                action.response = await self.room.send_command(
+                    command, *args, **self.command_kwargs
+                )
+            except Exception as e:
+                if not isinstance(e, ConnectionError):
+                    logger.error(f"Moderation in {self.room.name} stopped: {e!r}")
+                action.error = str(e) or type(e).__name__
+                action.exception = e
+            action.duration = time.monotonic() - sent_at
+            report.actions.append(action)
+            if not action.ok:
+                break
+        report.elapsed = time.monotonic() - started
+        return report
@@ -3,12 +3,15 @@ import asyncio
 import logging
 from typing import Optional, List, Dict
 
-from .utils import get_token, gen_uid, public_attributes
+from .utils import gen_uid, public_attributes
+from .http import token_manager
 from .exceptions import AlreadyConnectedError
 from .handler import CommandHandler, EventHandler
 from .connection import WebsocketConnection
 from .user import User, Friend, UserManager, Session
 from .message import _process_pm, message_cut, Command
+from .resources import user_resource_types
+from .fetch import resource_cache
 
 logger = logging.getLogger(__name__)
 
@@ -25,9 +28,9 @@ class PM(WebsocketConnection, EventHandler):
         self.port = 8081
         self.session: Session = Session(room=self, user=UserManager.get_user())
         self.reconnect = False
-        self.__token = None
 
         # internal state
+        self._login_name = None
         self._uid = gen_uid()
         self._silent = 0
         self._maxlen = 11600
@@ -80,15 +83,14 @@ class PM(WebsocketConnection, EventHandler):
         await self._connect(f"wss://{self.server}:{self.port}/")
 
         try:
-            if not self.__token:
-                self.__token = await get_token(user_name, password)
-
-            if not self.__token:
+            self._login_name = user_name
+            token = await token_manager.get(user_name, password)
+            if not token:
                 raise ConnectionError(
                     "Authentication failed: could not retrieve auth token."
                 )
 
-            handshake_args = ["tlogin", self.__token, "2"]
+            handshake_args = ["tlogin", token, "2"]
             if self.session.auth_token:
                 handshake_args.append(self.session.auth_token)
 
@@ -169,12 +171,12 @@ class PM(WebsocketConnection, EventHandler):
 
     async def handle_kickingoff(self, cmd: Command):
         self.call_event("kickingoff")
-        self.__token = None
+        token_manager.invalidate(self._login_name or self.user.name)
         await self.disconnect()
 
     async def handle_DENIED(self, cmd: Command):
         self.call_event("DENIED")
-        self.__token = None
+        token_manager.invalidate(self._login_name or self.user.name)
         await self.disconnect()
 
     async def handle_toofast(self, cmd: Command):
@@ -313,6 +315,7 @@ class PM(WebsocketConnection, EventHandler):
     async def handle_reload_profile(self, cmd: Command):
         args = cmd.args
         user = UserManager.get_user(name=args[0])
+        resource_cache.invalidate(user.name, user_resource_types)
         self.call_event("reload_profile", user)
 
     # --- Helper methods ---
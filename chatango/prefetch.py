@@ -0,0 +1,143 @@
+import heapq
+import asyncio
+import logging
+from itertools import count
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from .message import RoomMessage
+from .resources import user_resource_types
+from .fetch import resource_cache
+from .user import User
+
+if TYPE_CHECKING:
+    from .room import Room
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilePrefetcher:
+    """
+    Loads the styles, profile and background of room users in the background.
+
+    Add it as a listener on rooms (or pass it to Client). Users seen in the
+    message, join and participants events are queued once, and at most
+    concurrency of them are fetched at a time. Speakers come before users
+    who just joined, which come before the rest of the participant list.
+    Users whose resources are still fresh in resource_cache are skipped.
+    """
+
+    SPEAKER = 0
+    JOINED = 1
+    PRESENT = 2
+
+    concurrency = 4
+    maxsize = 10000
+
+    def __init__(
+        self, concurrency: Optional[int] = None, maxsize: Optional[int] = None
+    ):
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self._heap: List[Tuple[int, int, str]] = []
+        self._queued: Dict[str, Tuple[int, User]] = dict()
+        self._inflight: Set[str] = set()
+        self._workers: Set[asyncio.Task] = set()
+        self._order = count()
+        self.fetched = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    def __repr__(self):
+        return (
+            f"<ProfilePrefetcher queued:{len(self._queued)} "
+            f"inflight:{len(self._inflight)} fetched:{self.fetched}>"
+        )
+
+    def __len__(self):
+        return len(self._queued)
+
+    @staticmethod
+    def _is_warm(name: str) -> bool:
+        return all(resource_cache.contains(kind, name) for kind in user_resource_types)
+
+    def add(self, user: User, priority: int = PRESENT) -> bool:
+        """
+        Queues a user for prefetching, or raises the priority of a queued one.
+        Must be called from a running event loop.
+        @return: True if the user is now queued
+        """
+        if user.isanon:
+            return False
+        name = user.name
+        if name in self._inflight:
+            return False
+        queued = self._queued.get(name)
+        if queued is not None and queued[0] <= priority:
+            return True
+        if queued is None:
+            if self._is_warm(name):
+                self.skipped += 1
+                return False
+            if len(self._queued) >= self.maxsize:
+                self.dropped += 1
+                return False
+        self._queued[name] = (priority, user)
+        heapq.heappush(self._heap, (priority, next(self._order), name))
+        self._spawn()
+        return True
+
+    def _spawn(self):
+        while len(self._workers) < min(self.concurrency, len(self._queued)):
+            task = asyncio.ensure_future(self._worker())
+            self._workers.add(task)
+            task.add_done_callback(self._workers.discard)
+
+    def _pop(self) -> Optional[User]:
+        while self._heap:
+            priority, _, name = heapq.heappop(self._heap)
+            queued = self._queued.get(name)
+            # Skip entries superseded by a priority raise
+            if queued is not None and queued[0] == priority:
+                del self._queued[name]
+                return queued[1]
+        return None
+
+    async def _worker(self):
+        while (user := self._pop()) is not None:
+            name = user.name
+            self._inflight.add(name)
+            try:
+                await user.load_resources()
+                self.fetched += 1
+            except Exception as e:
+                logger.warning(f"Failed to prefetch resources of {name}: {e}")
+            finally:
+                self._inflight.discard(name)
+
+    async def join(self):
+        """Waits until the queue is empty and all fetches are done."""
+        while self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def close(self):
+        """Drops the queue and cancels running fetches."""
+        self._heap.clear()
+        self._queued.clear()
+        for task in self._workers:
+            task.cancel()
+
+    #
+    # Room listener callbacks
+    #
+
+    async def on_message(self, room: "Room", msg: RoomMessage):
+        self.add(msg.user, self.SPEAKER)
+
+    async def on_join(self, room: "Room", user: User):
+        self.add(user, self.JOINED)
+
+    async def on_participants(self, room: "Room"):
+        for session in room._participants:
+            self.add(session.user, self.PRESENT)
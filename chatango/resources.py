@@ -2,20 +2,25 @@ import time
 import re
 import json
 import datetime
-import xml.etree.ElementTree as ET
 import urllib.parse
-import asyncio
 import logging
-import socket
-import aiohttp
 from dataclasses import dataclass
-from typing import Dict, Any, Optional, Type, TypeVar, List, Protocol, runtime_checkable
-
-from .utils import get_aiohttp_session
+from typing import (
+    ClassVar,
+    Dict,
+    Optional,
+    Type,
+    TypeVar,
+    Protocol,
+    runtime_checkable,
+)
 
 T = TypeVar("T")
 logger = logging.getLogger(__name__)
 
+# fetch and save import the fetch module when called. It imports this one,
+# and loading it up front would pull aiohttp into every user object.
+
 
 @runtime_checkable
 class Fetchable(Protocol):
@@ -25,62 +30,72 @@ class Fetchable(Protocol):
     async def fetch(cls: Type[T], handle: str) -> T: ...
 
 
-async def _get_data(url: str) -> Optional[str]:
-    """Unified HTTP GET handler with robust exception and binary handling."""
-    try:
-        async with get_aiohttp_session().get(url) as resp:
-            if resp.status == 200:
-                # chatango sometimes returns a small image instead of XML for msgbg.xml
-                content_type = resp.headers.get("Content-Type", "").lower()
-                if "image" in content_type:
-                    logger.debug(f"Received image instead of text from {url}")
-                    return None
-                try:
-                    return await resp.text()
-                except (UnicodeDecodeError, aiohttp.ClientPayloadError) as e:
-                    logger.debug(f"Failed to decode text from {url}: {e}")
-                    return None
-            else:
-                logger.warning(f"HTTP error {resp.status} fetching {url}")
-
-    except (aiohttp.ClientResponseError, aiohttp.ClientConnectorError) as e:
-        logger.warning(f"Aiohttp error fetching {url}: {e}")
-    except (socket.gaierror, ConnectionResetError, asyncio.TimeoutError) as e:
-        logger.warning(f"Network error fetching {url}: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error fetching {url}: {e}")
-    return None
-
+# Characters fed to the XML parser at a time by _find_xml_element
+_xml_chunk_size = 16384
+_leading_space = re.compile(r"\s*")
+
+
+def _find_xml_element(
+    data: str, tag: str, depth: Optional[int] = None, attrs_only: bool = False
+):
+    """
+    Finds the first tag element of a document.
+
+    The document is parsed as if wrapped in a root element, so fragments
+    with several top-level elements are accepted, and a leading XML
+    declaration is skipped without a regex pass over the whole text.
+    Well-formed documents are parsed in one go, which is faster than
+    incremental parsing at any size. Fragments and documents malformed
+    after the element are parsed incrementally instead, stopping as soon
+    as the element is found.
+    @param depth: only match elements at this depth, 1 being top level
+    @param attrs_only: when parsing incrementally, return as soon as the
+    start tag is read, for elements whose attributes are all that is needed
+    @return: the element, or None if the document has none
+    @raise ValueError: on malformed XML before a match
+    """
+    # Imported here so the resource classes load without the XML parser
+    import xml.etree.ElementTree as ET
+
+    start = _leading_space.match(data).end()
+    if data.startswith("<?xml", start):
+        end = data.find("?>", start)
+        if end != -1:
+            start = end + 2
 
-async def _post_data(url: str, data: Dict[str, str]) -> Optional[str]:
-    """Unified HTTP POST handler with robust exception handling."""
     try:
-        async with get_aiohttp_session().post(url, data=data) as resp:
-            if resp.status == 200:
-                return await resp.text()
-            else:
-                logger.warning(f"HTTP error {resp.status} posting to {url}")
-
-    except (aiohttp.ClientResponseError, aiohttp.ClientConnectorError) as e:
-        logger.warning(f"Aiohttp error posting to {url}: {e}")
-    except (socket.gaierror, ConnectionResetError, asyncio.TimeoutError) as e:
-        logger.warning(f"Network error posting to {url}: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error posting to {url}: {e}")
+        root = ET.fromstring(data[start:])
+    except ET.ParseError:
+        pass
+    else:
+        if depth is None:
+            return next(root.iter(tag), None)
+        if depth == 1:
+            return root if root.tag == tag else None
+        return root.find("/".join(["*"] * (depth - 2) + [tag]))
+
+    parser = ET.XMLPullParser(("start", "end"))
+    parser.feed("<root>")
+    level = 0
+    try:
+        for offset in range(start, len(data), _xml_chunk_size):
+            parser.feed(data[offset : offset + _xml_chunk_size])
+            for event, elem in parser.read_events():
+                if event == "start":
+                    level += 1
+                    if attrs_only and elem.tag == tag and depth in (None, level - 1):
+                        return elem
+                else:
+                    if elem.tag == tag and depth in (None, level - 1):
+                        return elem
+                    level -= 1
+        parser.feed("</root>")
+        parser.close()
+    except ET.ParseError as e:
+        raise ValueError(f"Malformed XML: {e}") from e
     return None
 
 
-async def fetch_resources(
-    handle: str, resource_types: List[Type[Fetchable]]
-) -> List[Any]:
-    """Fetches multiple resources in parallel for a given handle."""
-    if not handle:
-        return []
-
-    tasks = [res_type.fetch(handle) for res_type in resource_types]
-    return list(await asyncio.gather(*tasks))
-
-
 class PathProvider:
     """Utility to generate canonical Chatango resource paths."""
 
@@ -113,11 +128,23 @@ class PathProvider:
         root = "/groupinfo" if resource == "gprofile.xml" else "/profileimg"
         return f"{domain}{root}{path}/{resource}"
 
+    @classmethod
+    def get_image_url(
+        cls, handle: str, image_id: str, domain: str = "http://ust.chatango.com"
+    ) -> str:
+        """URL of an image uploaded by a user."""
+        path = cls.get_user_path(handle)
+        if not path:
+            return ""
+        return f"{domain}/um{path}/img/t_{image_id}.jpg"
+
 
 @dataclass
 class MessageBackground:
     """Models message background properties from msgbg.xml."""
 
+    cache_buster: ClassVar[bool] = True
+
     align: str = "tl"
     bg_alpha: int = 100
     bg_color: str = "ffffff"
@@ -132,16 +159,10 @@ class MessageBackground:
         """Parses msgbg.xml content, robust against malformed or non-XML text."""
         obj = cls()
         try:
-            if not data or "<bgi" not in data.lower():
-                return obj
-
-            data = re.sub(r"<\?xml.*?\?>", "", data).strip()
-            if not data:
+            if not data or "<bgi" not in data:
                 return obj
-            root = ET.fromstring(data)
-            if root.tag != "bgi":
-                root = root.find(".//bgi")
 
+            root = _find_xml_element(data, "bgi", attrs_only=True)
             if root is not None:
                 obj.align = root.get("align", obj.align)
                 obj.bg_alpha = int(root.get("bgalp", obj.bg_alpha))
@@ -151,7 +172,7 @@ class MessageBackground:
                 obj.tile = root.get("tile") == "1"
                 obj.is_video = root.get("isvid") == "1"
                 obj.last_update = time.time()
-        except (ET.ParseError, ValueError, TypeError) as e:
+        except (ValueError, TypeError) as e:
             logger.debug(f"Failed to parse msgbg.xml: {e}")
         except Exception as e:
             logger.warning(f"Unexpected error parsing msgbg.xml: {e}")
@@ -171,12 +192,14 @@ class MessageBackground:
 
     @classmethod
     async def fetch(cls, handle: str) -> "MessageBackground":
-        url = PathProvider.get_resource_url(handle, "msgbg.xml")
-        data = await _get_data(f"{url}?cb={time.time()}")
-        return cls.from_xml(data) if data else cls()
+        from .fetch import _fetch_resource
+
+        return await _fetch_resource(cls, handle, "msgbg.xml", cls.from_xml)
 
     @classmethod
     async def save(cls, handle: str, password: str, obj: "MessageBackground") -> bool:
+        from .fetch import _post_data, resource_cache
+
         url = "https://chatango.com/updatemsgbg"
         data = obj.to_dict()
         data.update(
@@ -186,13 +209,17 @@ class MessageBackground:
                 "hasrec": str(int(obj.last_update)),
             }
         )
-        return await _post_data(url, data) is not None
+        success = await _post_data(url, data) is not None
+        resource_cache.invalidate(handle, [cls])
+        return success
 
 
 @dataclass
 class Styles:
     """Models message styles."""
 
+    cache_buster: ClassVar[bool] = True
+
     name_color: str = "000000"
     text_color: str = "000000"
     font_size: int = 11
@@ -350,12 +377,14 @@ class Styles:
 
     @classmethod
     async def fetch(cls, handle: str) -> "Styles":
-        url = PathProvider.get_resource_url(handle, "msgstyles.json")
-        data = await _get_data(f"{url}?cb={time.time()}")
-        return cls.from_json(data) if data else cls()
+        from .fetch import _fetch_resource
+
+        return await _fetch_resource(cls, handle, "msgstyles.json", cls.from_json)
 
     @classmethod
     async def save(cls, handle: str, password: str, obj: "Styles") -> bool:
+        from .fetch import _post_data, resource_cache
+
         url = "https://chatango.com/updatemsgstyles"
         data = obj.to_dict()
         data.update(
@@ -365,7 +394,9 @@ class Styles:
                 "hasrec": str(int(time.time())),
             }
         )
-        return await _post_data(url, data) is not None
+        success = await _post_data(url, data) is not None
+        resource_cache.invalidate(handle, [cls])
+        return success
 
     @property
     def font_color(self) -> str:
@@ -380,6 +411,8 @@ class Styles:
 class UserProfile:
     """Models user profile data from mod1.xml."""
 
+    cache_buster: ClassVar[bool] = True
+
     gender: str = "?"
     location: str = ""
     latitude: Optional[float] = None
@@ -406,11 +439,9 @@ class UserProfile:
         """Parses mod1.xml content."""
         obj = cls()
         try:
-            data = re.sub(r"<\?xml.*?\?>", "", data).strip()
             if not data:
                 return obj
-            root = ET.fromstring(f"<root>{data}</root>")
-            mod = root.find("mod")
+            mod = _find_xml_element(data, "mod", depth=1)
             if mod is None:
                 return obj
 
@@ -442,7 +473,7 @@ class UserProfile:
                     pass
 
             obj.last_update = time.time()
-        except (ET.ParseError, ValueError, TypeError) as e:
+        except (ValueError, TypeError) as e:
             logger.debug(f"Failed to parse mod1.xml: {e}")
         except Exception as e:
             logger.warning(f"Unexpected error parsing mod1.xml: {e}")
@@ -474,12 +505,14 @@ class UserProfile:
 
     @classmethod
     async def fetch(cls, handle: str) -> "UserProfile":
-        url = PathProvider.get_resource_url(handle, "mod1.xml")
-        data = await _get_data(f"{url}?cb={time.time()}")
-        return cls.from_mod1(data) if data else cls()
+        from .fetch import _fetch_resource
+
+        return await _fetch_resource(cls, handle, "mod1.xml", cls.from_mod1)
 
     @classmethod
     async def save(cls, handle: str, password: str, obj: "UserProfile") -> bool:
+        from .fetch import _post_data, resource_cache
+
         url = "https://chatango.com/updateprofile"
 
         # 1. First POST to fetch fields (as seen in JS load())
@@ -503,13 +536,17 @@ class UserProfile:
         update_data.update(obj.to_dict())
         update_data["action"] = "update"
 
-        return await _post_data(url, update_data) is not None
+        success = await _post_data(url, update_data) is not None
+        resource_cache.invalidate(handle, [cls])
+        return success
 
 
 @dataclass(repr=False)
 class RoomProfile:
     """Models room profile data from gprofile.xml."""
 
+    cache_buster: ClassVar[bool] = True
+
     group_title: str = ""
     group_body_html: str = ""
     last_update: float = 0.0
@@ -522,16 +559,10 @@ class RoomProfile:
         """Parses gprofile.xml content looking for <gp> tags."""
         obj = cls()
         try:
-            data = re.sub(r"<\?xml.*?\?>", "", data).strip()
             if not data:
                 return obj
 
-            try:
-                root = ET.fromstring(data)
-            except ET.ParseError:
-                root = ET.fromstring(f"<root>{data}</root>")
-
-            gp = root if root.tag == "gp" else root.find(".//gp")
+            gp = _find_xml_element(data, "gp")
             if gp is not None:
                 desc_tag = gp.find("desc")
                 if desc_tag is not None and desc_tag.text:
@@ -542,7 +573,7 @@ class RoomProfile:
                     obj.group_title = urllib.parse.unquote(title_tag.text)
 
                 obj.last_update = time.time()
-        except (ET.ParseError, ValueError, TypeError) as e:
+        except (ValueError, TypeError) as e:
             logger.debug(f"Failed to parse gprofile.xml: {e}")
         except Exception as e:
             logger.warning(f"Unexpected error parsing gprofile.xml: {e}")
@@ -560,12 +591,14 @@ class RoomProfile:
 
     @classmethod
     async def fetch(cls, handle: str) -> "RoomProfile":
-        url = PathProvider.get_resource_url(handle, "gprofile.xml")
-        data = await _get_data(f"{url}?cb={time.time()}")
-        return cls.from_xml(data) if data else cls()
+        from .fetch import _fetch_resource
+
+        return await _fetch_resource(cls, handle, "gprofile.xml", cls.from_xml)
 
     @classmethod
     async def save(cls, handle: str, password: str, obj: "RoomProfile") -> bool:
+        from .fetch import _post_data, resource_cache
+
         url = "https://chatango.com/updategroupprofile"
         data = obj.to_dict(handle)
         data.update(
@@ -574,4 +607,28 @@ class RoomProfile:
                 "p": password,
             }
         )
-        return await _post_data(url, data) is not None
+        success = await _post_data(url, data) is not None
+        resource_cache.invalidate(handle, [cls])
+        return success
+
+
+# Resources of a user, reloaded together by User.load_resources
+user_resource_types = (Styles, UserProfile, MessageBackground)
+
+# Fetching, uploads and the resource cache now live in the fetch module,
+# still importable from here without making this module import aiohttp
+_moved_to_fetch = (
+    "ResourceCache",
+    "ResourceStore",
+    "fetch_resources",
+    "resource_cache",
+    "upload_image",
+)
+
+
+def __getattr__(name):
+    if name in _moved_to_fetch:
+        from . import fetch
+
+        return getattr(fetch, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,8 +6,8 @@ import re
 import logging
 import urllib.parse as urlreq
 
-from collections import deque, namedtuple
-from typing import Optional, Tuple
+from collections import OrderedDict, deque, namedtuple
+from typing import Any, Dict, List, Optional, Tuple
 from attr import dataclass
 
 from .utils import (
@@ -24,8 +24,11 @@ from .message import (
     Command,
     MessageHistory,
 )
-from .user import RegisteredUser, User, ModeratorFlags, AdminFlags, UserManager, Session
-from .resources import RoomProfile, fetch_resources
+from .user import User, ModeratorFlags, AdminFlags, UserManager, Session
+from .resources import RoomProfile, user_resource_types
+from .fetch import fetch_resources, resource_cache
+from .archive import MessageArchive
+from .moderation import ModerationExecutor, ModerationReport
 from .exceptions import AlreadyConnectedError, InvalidRoomNameError
 from .handler import EventHandler
 from .connection import WebsocketConnection
@@ -59,11 +62,306 @@ class RoomFlags(enum.IntFlag):
     UNSAFE = 1 << 29
 
 
+class PendingQueue:
+    """
+    Holds b/u frames waiting for their partner frame, bounded by size
+    and age. Entries older than ttl seconds, or the oldest entries once
+    maxlen is exceeded, are handed back by expire() as orphans.
+    """
+
+    def __init__(self, maxlen: int = 500, ttl: float = 30.0):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.orphaned = 0
+        self._items: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __repr__(self):
+        return f"<PendingQueue {len(self)}/{self.maxlen} orphaned:{self.orphaned}>"
+
+    def put(self, key: str, value: Any):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+
+    def pop(self, key: str, default=None):
+        item = self._items.pop(key, None)
+        return item[1] if item else default
+
+    def next_deadline(self) -> Optional[float]:
+        """Monotonic time at which the oldest entry expires."""
+        for deadline, _ in self._items.values():
+            return deadline
+        return None
+
+    def expire(self, now: Optional[float] = None) -> List[Tuple[str, Any]]:
+        """Removes and returns entries past their deadline or over maxlen."""
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self._items:
+            key, (deadline, value) = next(iter(self._items.items()))
+            if deadline > now and len(self._items) <= self.maxlen:
+                break
+            del self._items[key]
+            expired.append((key, value))
+        self.orphaned += len(expired)
+        return expired
+
+
+class BanList:
+    """
+    Ban records keyed by target user, with secondary indexes by encoded
+    cookie and IP so unblock and lookup never scan the whole list.
+    """
+
+    def __init__(self):
+        self._by_user: Dict[User, Any] = dict()
+        self._by_cookie: Dict[str, Dict[User, Any]] = dict()
+        self._by_ip: Dict[str, Dict[User, Any]] = dict()
+
+    def __len__(self):
+        return len(self._by_user)
+
+    def __contains__(self, user):
+        return user in self._by_user
+
+    def __iter__(self):
+        return iter(self._by_user.values())
+
+    def __repr__(self):
+        return f"<BanList {len(self)}>"
+
+    def users(self) -> List[User]:
+        return list(self._by_user.keys())
+
+    def get(self, user: User):
+        return self._by_user.get(user)
+
+    def by_cookie(self, encoded_cookie: str) -> list:
+        return list(self._by_cookie.get(encoded_cookie, {}).values())
+
+    def by_ip(self, ip: str) -> list:
+        return list(self._by_ip.get(ip, {}).values())
+
+    @staticmethod
+    def _link(index: dict, key: str, record):
+        if key:
+            index.setdefault(key, dict())[record.target] = record
+
+    @staticmethod
+    def _unlink(index: dict, key: str, record):
+        if (records := index.get(key)) and records.get(record.target) is record:
+            del records[record.target]
+            if not records:
+                del index[key]
+
+    def add(self, record):
+        """Adds or replaces the ban record for its target user."""
+        if old := self._by_user.get(record.target):
+            if old == record:
+                return
+            self.remove(old)
+        self._by_user[record.target] = record
+        self._link(self._by_cookie, record.encoded_cookie, record)
+        self._link(self._by_ip, record.ip, record)
+
+    def remove(self, record):
+        if self._by_user.get(record.target) is not record:
+            return
+        del self._by_user[record.target]
+        self._unlink(self._by_cookie, record.encoded_cookie, record)
+        self._unlink(self._by_ip, record.ip, record)
+
+    def replace(self, records):
+        """Applies a full listing, only touching records that changed."""
+        new = {record.target: record for record in records}
+        for record in list(self._by_user.values()):
+            if new.get(record.target) != record:
+                self.remove(record)
+        for record in new.values():
+            self.add(record)
+
+    def clear(self):
+        self._by_user.clear()
+        self._by_cookie.clear()
+        self._by_ip.clear()
+
+
+class ParticipantList:
+    """
+    Participant sessions keyed by SSID. Counters by user type and indexes
+    by user, IP and cookie are updated with each change rather than
+    recomputed on read.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, Session] = dict()
+        self._by_user: Dict[User, Dict[str, Session]] = dict()
+        self._by_ip: Dict[str, Dict[str, Session]] = dict()
+        self._by_cookie: Dict[str, Dict[str, Session]] = dict()
+        self.registered_count = 0
+        self.temp_count = 0
+        self.anon_count = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, ssid):
+        return ssid in self._sessions
+
+    def __iter__(self):
+        return iter(self._sessions.values())
+
+    def __repr__(self):
+        return "<ParticipantList registered:{} temp:{} anon:{}>".format(
+            self.registered_count, self.temp_count, self.anon_count
+        )
+
+    def get(self, ssid: str) -> Optional[Session]:
+        return self._sessions.get(ssid)
+
+    def users(self) -> List[User]:
+        return list(self._by_user.keys())
+
+    def is_present(self, user: User) -> bool:
+        return user in self._by_user
+
+    def sessions_for(
+        self,
+        user: Optional[User] = None,
+        ip: Optional[str] = None,
+        cookie: Optional[str] = None,
+    ) -> List[Session]:
+        """Sessions matching every given criteria."""
+        found = None
+        for index, key in (
+            (self._by_user, user),
+            (self._by_ip, ip),
+            (self._by_cookie, cookie),
+        ):
+            if key is None:
+                continue
+            sessions = index.get(key, {})
+            found = (
+                dict(sessions)
+                if found is None
+                else {k: v for k, v in found.items() if k in sessions}
+            )
+        return list(found.values()) if found else []
+
+    def _count(self, user: User, delta: int):
+        if user.istemp:
+            self.temp_count += delta
+        elif user.isanon:
+            self.anon_count += delta
+        else:
+            self.registered_count += delta
+
+    @staticmethod
+    def _link(index: dict, key, session: Session):
+        if key:
+            index.setdefault(key, dict())[session.ssid] = session
+
+    @staticmethod
+    def _unlink(index: dict, key, session: Session):
+        if (sessions := index.get(key)) and sessions.pop(session.ssid, None):
+            if not sessions:
+                del index[key]
+
+    def _index(self, session: Session):
+        self._link(self._by_user, session.user, session)
+        self._link(self._by_ip, session.ip, session)
+        self._link(self._by_cookie, session.short_cookie, session)
+        self._count(session.user, 1)
+
+    def _unindex(self, session: Session):
+        self._unlink(self._by_user, session.user, session)
+        self._unlink(self._by_ip, session.ip, session)
+        self._unlink(self._by_cookie, session.short_cookie, session)
+        self._count(session.user, -1)
+
+    def add(self, session: Session):
+        if old := self._sessions.get(session.ssid):
+            self._unindex(old)
+        self._sessions[session.ssid] = session
+        self._index(session)
+
+    def remove(self, ssid: str) -> Optional[Session]:
+        session = self._sessions.pop(ssid, None)
+        if session:
+            self._unindex(session)
+        return session
+
+    def update(self, session: Session, **fields):
+        """Changes session attributes such as user or ip, keeping indexes in step."""
+        self._unindex(session)
+        for key, value in fields.items():
+            setattr(session, key, value)
+        self._index(session)
+
+    def clear(self):
+        self._sessions.clear()
+        self._by_user.clear()
+        self._by_ip.clear()
+        self._by_cookie.clear()
+        self.registered_count = self.temp_count = self.anon_count = 0
+
+
+class RoomSnapshot:
+    """
+    Room state saved by Room.snapshot(), applied with Room.restore(). Holds
+    references to the room's objects, which keep changing while connected.
+    """
+
+    def __init__(self, room_name: str, state: Dict[str, Any]):
+        self.room_name = room_name
+        self.time = time.time()
+        self.state = state
+
+    def __repr__(self):
+        return f"<RoomSnapshot {self.room_name} {len(self.state)} fields>"
+
+
 class Room(WebsocketConnection, EventHandler):
     _BANDATA = namedtuple("BanData", ["encoded_cookie", "ip", "target", "time", "src"])
 
     valid_name = re.compile("^([a-z0-9-]{1,20})$")
 
+    # Keep a full-text index over history, enables fast search()
+    history_search = False
+
+    # Limits for messages (b) and ids (u) waiting for their partner frame
+    pending_maxlen = 500
+    pending_ttl = 30.0
+    # Emit expired messages with their temporary id instead of dropping them
+    emit_orphans = False
+
+    # Maximum get_more pages requested to cover a gap after reconnecting
+    backfill_max_pages = 10
+
+    # State kept across a bounce when reconnecting, see snapshot()
+    _snapshot_fields = (
+        "_owner",
+        "_flags",
+        "_version",
+        "_profile",
+        "_announcement",
+        "_banned_words",
+        "_rate_limit",
+        "_history",
+        "_participants",
+        "_usercount",
+        "_anoncount",
+        "_mods",
+        "_banlist",
+        "_unbanlist",
+        "_unbanqueue",
+    )
+
     command_responses = {
         "v": "v",
         "bauth": "ok",
@@ -113,6 +411,10 @@ class Room(WebsocketConnection, EventHandler):
         self.reconnect = False
         self.silent = False
         self.message_flags = 0
+        self._archive: Optional[MessageArchive] = None
+        self._pending_sweep: Optional[asyncio.Task] = None
+        self._last_seen_id: Optional[str] = None
+        self._last_seen_time: Optional[float] = None
         self._reset_state(name)
 
     def _reset_state(self, name: str):
@@ -127,20 +429,24 @@ class Room(WebsocketConnection, EventHandler):
         self._announcement: Optional[Room.Announcement] = None
         self._banned_words: Optional[Tuple[str, str]] = None
         self._rate_limit: Optional[int] = None
-        self._mqueue = dict()
-        self._uqueue = dict()
-        self._history = MessageHistory(maxlen=3000)
-        self._userdict = dict()
+        self._mqueue = PendingQueue(self.pending_maxlen, self.pending_ttl)
+        self._uqueue = PendingQueue(self.pending_maxlen, self.pending_ttl)
+        self._history = MessageHistory(maxlen=3000, search=self.history_search)
+        self._participants = ParticipantList()
         self._usercount: Optional[int] = None
         self._anoncount: Optional[int] = None
         self._mods = dict()
-        self._banlist = dict()
+        self._banlist = BanList()
         self._unbanlist = dict()
         self._unbanqueue = deque(maxlen=500)
         self._maxlen = 2800
         self._bgmode = 0
         self._gotmore: Optional[int] = None
         self._nomore = False
+        self._restored = False
+        self._recovery: Optional[List[RoomMessage]] = None
+        self._recovery_since = 0.0
+        self._gap_covered = False
 
     def __dir__(self):
         return public_attributes(self)
@@ -262,7 +568,7 @@ class Room(WebsocketConnection, EventHandler):
 
     @property
     def banlist(self):
-        return list(self._banlist.keys())
+        return self._banlist.users()
 
     @property
     def mods(self):
@@ -271,7 +577,7 @@ class Room(WebsocketConnection, EventHandler):
     @property
     def userlist(self):
         if self._anoncount is not None:
-            return [s.user for s in self._userdict.values()]
+            return [s.user for s in self._participants]
         else:
             raise AttributeError(
                 "User list not available, first send the gparticipants command"
@@ -282,9 +588,7 @@ class Room(WebsocketConnection, EventHandler):
         if self._usercount is not None:
             return self._usercount
         elif self._anoncount is not None:
-            return self._anoncount + len(
-                [u for u in self.userlist if isinstance(u, RegisteredUser)]
-            )
+            return self._anoncount + self._participants.registered_count
         else:
             raise AttributeError(
                 "User list not available, first send the gparticipants command"
@@ -299,6 +603,24 @@ class Room(WebsocketConnection, EventHandler):
                 "User list not available, first send the gparticipants command"
             )
 
+    def is_present(self, user) -> bool:
+        """
+        Checks if a user has a session in the room, requires participants.
+        @param user: User object or name string
+        """
+        if isinstance(user, str):
+            user = UserManager.get_user(name=user)
+        return self._participants.is_present(user)
+
+    def sessions_for(self, user=None, ip=None, cookie=None) -> List[Session]:
+        """
+        Participant sessions matching a user, IP and/or short cookie.
+        @param user: User object or name string
+        """
+        if isinstance(user, str):
+            user = UserManager.get_user(name=user)
+        return self._participants.sessions_for(user=user, ip=ip, cookie=cookie)
+
     async def _connect_server(self):
         """
         Connect to the websocket server
@@ -306,6 +628,9 @@ class Room(WebsocketConnection, EventHandler):
         if self.connected:
             raise AlreadyConnectedError(self.name)
 
+        if self._archive is not None and not self._history:
+            self.warm_history()
+
         await self._connect(f"wss://{self.server}:8081/")
         self.call_event("connect")
 
@@ -313,8 +638,35 @@ class Room(WebsocketConnection, EventHandler):
         """
         Disconnect from the websocket server
         """
+        snapshot = self.snapshot() if self.reconnect else None
         await super()._disconnect()
         self._reset_state(self.name)
+        if snapshot:
+            self.restore(snapshot)
+
+    def snapshot(self) -> RoomSnapshot:
+        """
+        Captures room state such as owner, mods, flags, history, participants
+        and ban lists. Used to keep state across reconnects: the snapshot
+        holds the live objects rather than copies, so it is only meant to be
+        passed to restore() right after a disconnect, as _disconnect does.
+        Paging state of get_more belongs to one connection and is not kept.
+        """
+        return RoomSnapshot(
+            self.name, {field: getattr(self, field) for field in self._snapshot_fields}
+        )
+
+    def restore(self, snapshot: RoomSnapshot):
+        """
+        Applies a snapshot of this room. After the next connect only state that
+        may have changed is requested again, in the background.
+        """
+        if snapshot.room_name != self.name:
+            raise ValueError(f"Snapshot of {snapshot.room_name} cannot restore {self}")
+        for field, value in snapshot.state.items():
+            setattr(self, field, value)
+        self._restored = True
+        self.call_event("restored", snapshot)
 
     async def _connection_wait(self):
         """
@@ -361,6 +713,16 @@ class Room(WebsocketConnection, EventHandler):
         Send websocket commands to connect and login to the room
         """
         try:
+            since = self._last_seen_time
+            if since is None:
+                # Restored history that was never marked seen
+                since = self._history.newest_time
+            if since is not None and self._history:
+                # History replayed after reconnecting is checked for a gap
+                self._recovery = []
+                self._recovery_since = since
+                self._gap_covered = False
+                self._nomore = False
             await self.send_command("v", expect="v")
             await self._auth(user_name, password, expect="ok")
             if self.user.isanon:
@@ -368,7 +730,11 @@ class Room(WebsocketConnection, EventHandler):
             else:
                 await self.get_premium()
                 await self._style_init(self.user)
-            await self.get_room_info()
+            if self._restored:
+                self._restored = False
+                self.add_task(self._refresh_state())
+            else:
+                await self.get_room_info()
         except TimeoutError as e:
             logger.error(f"Failed initialization handshake for {self.name}: {e}")
             raise ConnectionError() from e
@@ -442,6 +808,12 @@ class Room(WebsocketConnection, EventHandler):
         # await self.request_unbanlist()
         await self.load_profile()
 
+    async def _refresh_state(self):
+        """Requests state that may have changed while a restored room was offline."""
+        await self.get_room_info()
+        if self._anoncount is not None:
+            await self.request_participants()
+
     async def get_premium(self, **kwargs):
         """Request logged in user's premium status"""
         return await self.send_command("getpremium", **kwargs)
@@ -494,7 +866,34 @@ class Room(WebsocketConnection, EventHandler):
             return self._history.last()
         if isinstance(user, str):
             user = UserManager.get_user(name=user)
-        return next((m for m in reversed(self._history) if m.user == user), None)
+        return self._history.last_by_user(user)
+
+    def use_archive(self, archive: MessageArchive):
+        """
+        Records this room's messages to an archive, and warms history from
+        it whenever the room connects with an empty history.
+        """
+        self._archive = archive
+        self.add_listener(archive)
+
+    def warm_history(self):
+        """Replaces history with the newest messages from the archive."""
+        if self._archive is not None:
+            self._history = self._archive.load_history(self, self._history.maxlen)
+            self.call_event("history_warmed", len(self._history))
+
+    def search(self, terms, user=None, since=None, limit=20) -> List[RoomMessage]:
+        """
+        Searches message bodies in history, newest first.
+        Quoted parts of terms are matched as phrases, other words must all appear.
+        @param terms: query string or list of terms
+        @param user: User object or name string
+        @param since: only messages sent at or after this timestamp
+        @param limit: maximum number of results, None for all
+        """
+        if isinstance(user, str):
+            user = UserManager.get_user(name=user)
+        return self._history.search(terms, user=user, since=since, limit=limit)
 
     async def get_more(self, n: int = 20, **kwargs):
         """
@@ -531,24 +930,34 @@ class Room(WebsocketConnection, EventHandler):
         if user == self.owner:
             return 3
         mod_user = self._mods.get(user)
-        if not mod_user:
+        if mod_user is None:
             return 0
-        elif mod_user.isadmin:
+        elif mod_user & AdminFlags:
             return 2
         else:
             return 1
 
-    def ban_record(self, user):
-        if isinstance(user, str):
-            user = UserManager.get_user(name=user)
-        return self._banlist.get(user)
+    def ban_record(self, user=None, encoded_cookie=None, ip=None):
+        """
+        Finds a ban record by user, or else by encoded cookie or IP.
+        @param user: User object or name string
+        """
+        if user is not None:
+            if isinstance(user, str):
+                user = UserManager.get_user(name=user)
+            return self._banlist.get(user)
+        records = []
+        if encoded_cookie:
+            records = self._banlist.by_cookie(encoded_cookie)
+        if not records and ip:
+            records = self._banlist.by_ip(ip)
+        return records[0] if records else None
 
     async def _raw_unban(self, name, ip, encoded_cookie):
         await self.send_command("removeblock", encoded_cookie, ip, name)
 
     async def unban_user(self, user):
         rec = self.ban_record(user)
-        print("rec", rec)
         if rec:
             await self._raw_unban(rec.target.name, rec.ip, rec.encoded_cookie)
             return True
@@ -579,7 +988,7 @@ class Room(WebsocketConnection, EventHandler):
         @return: Bool indicando si se envió el comando
         """
         msg = self.get_last_message(user)
-        if msg and msg.user not in self.banlist:
+        if msg and msg.user not in self._banlist:
             return await self.ban_message(msg)
         return False
 
@@ -615,15 +1024,50 @@ class Room(WebsocketConnection, EventHandler):
         else:
             raise ValueError("No message for user, cannot delete")
 
-    async def delete_user_all(self, user, **kwargs):
+    async def delete_user_all(
+        self,
+        user,
+        *,
+        interval: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        **kwargs,
+    ):
         """
         Deletes all messages sent by a specific user in the current session.
         @param user: User object or name string
+        @param interval: seconds between commands, see ModerationExecutor
+        @param batch_size: message ids per delallmsg command
+        @param kwargs: passed to send_command, e.g. wait_for_response
+        @return: send_command result of the last delete command
         """
-        # TODO bot user privilege check
-        # TODO fetch all msg ids for user
-        # return await self.send_command("delallmsg", *msgids, **kwargs)
-        raise AttributeError("delete_user_all not implemented")
+        if isinstance(user, str):
+            user = UserManager.get_user(name=user)
+        if not self._history.ids_by_user(user):
+            raise ValueError("No messages for user, cannot delete")
+        executor = ModerationExecutor(self, interval, batch_size, kwargs)
+        report = await executor.run([user])
+        if report.actions and report.actions[-1].exception is not None:
+            raise report.actions[-1].exception
+        return report.actions[-1].response if report.actions else None
+
+    async def moderate(
+        self,
+        users,
+        delete: bool = True,
+        ban: bool = False,
+        interval: Optional[float] = None,
+        batch_size: Optional[int] = None,
+    ) -> ModerationReport:
+        """
+        Deletes all messages in history from many users, optionally banning them,
+        with batched and paced commands.
+        @param users: User objects or name strings
+        @param interval: seconds between commands, see ModerationExecutor
+        @param batch_size: message ids per delallmsg command
+        @return: ModerationReport with the actions completed and their timing
+        """
+        executor = ModerationExecutor(self, interval, batch_size)
+        return await executor.run(users, delete=delete, ban=ban)
 
     async def request_unbanlist(self):
         await self.send_command(
@@ -754,8 +1198,37 @@ class Room(WebsocketConnection, EventHandler):
 
     async def handle_inited(self, _):
         """Signals that first page of chat history has been sent"""
+        if self._recovery is not None:
+            self.add_task(self._backfill())
         self.call_event("inited")
 
+    async def _backfill(self):
+        """
+        Requests more history until messages missed while disconnected are
+        covered, then adds them to history as message_recovered events.
+        """
+        recovered = self._recovery
+        pages = 0
+        try:
+            while (
+                not self._gap_covered
+                and not self._nomore
+                and pages < self.backfill_max_pages
+            ):
+                await self.get_more(50, wait_for_response=True)
+                pages += 1
+        except (TimeoutError, ConnectionError) as e:
+            logger.warning(f"History backfill for {self.name} incomplete: {e}")
+        finally:
+            if self._recovery is recovered:
+                self._recovery = None
+            for msg in sorted(recovered, key=lambda m: m.time):
+                if msg.id not in self._history:
+                    # Live messages may have arrived while backfilling
+                    self._history.insort(msg.id, msg)
+                    self._mark_seen(msg)
+                    self.call_event("message_recovered", msg)
+
     async def handle_gotmore(self, cmd: Command):
         """
         Confirms additional history received.
@@ -895,9 +1368,29 @@ class Room(WebsocketConnection, EventHandler):
         Format: i:TS:SID:TNAME:COOKIE_SHORT:COOKIE_ENC:MSGID:IP:FLAGS:RESERVED:TEXT
         """
         msg = await _process(self, cmd.args)
-        self._history.appendleft(msg.id, msg)
+        if msg.id in self._history:
+            # Already stored, replayed after a reconnect
+            self._gap_covered = True
+            return
+        if self._recovery is not None:
+            if msg.time > self._recovery_since:
+                self._recovery.append(msg)
+                return
+            self._gap_covered = True
+        newest = self._history.newest_time
+        if newest is not None and msg.time > newest:
+            self._history.insort(msg.id, msg)
+        else:
+            self._history.appendleft(msg.id, msg)
+        self._mark_seen(msg)
         self.call_event("message_history", msg)
 
+    def _mark_seen(self, msg: RoomMessage):
+        """Remembers the newest message seen, used to find gaps after reconnecting."""
+        if self._last_seen_time is None or msg.time >= self._last_seen_time:
+            self._last_seen_id = msg.id
+            self._last_seen_time = msg.time
+
     async def handle_b(self, cmd: Command):
         """
         Processes live broadcast messages from the room.
@@ -908,9 +1401,11 @@ class Room(WebsocketConnection, EventHandler):
         if args[5] in self._uqueue:
             msg.id = self._uqueue.pop(args[5])
             self._history.append(msg.id, msg)
+            self._mark_seen(msg)
             self.call_event("message", msg)
         else:
-            self._mqueue[msg.id] = msg
+            self._mqueue.put(msg.id, msg)
+            self._expire_pending()
 
     async def handle_u(self, cmd: Command):
         """
@@ -922,9 +1417,43 @@ class Room(WebsocketConnection, EventHandler):
             msg = self._mqueue.pop(args[0])
             msg.id = args[1]
             self._history.append(msg.id, msg)
+            self._mark_seen(msg)
             self.call_event("message", msg)
         else:
-            self._uqueue[args[0]] = args[1]
+            self._uqueue.put(args[0], args[1])
+            self._expire_pending()
+
+    def _expire_pending(self):
+        """
+        Drops b and u frames whose partner never arrived, calling the orphan
+        event for each as (temp_id, msg_id, msg). Unmatched b frames have no
+        msg_id and unmatched u frames have no msg, the missing one is None.
+        Schedules a sweep while anything is still waiting.
+        """
+        for temp_id, msg in self._mqueue.expire():
+            if self.emit_orphans:
+                self._history.append(temp_id, msg)
+                self.call_event("message", msg)
+            self.call_event("orphan", temp_id, None, msg)
+        for temp_id, msg_id in self._uqueue.expire():
+            self.call_event("orphan", temp_id, msg_id, None)
+
+        if (self._mqueue or self._uqueue) and (
+            self._pending_sweep is None or self._pending_sweep.done()
+        ):
+            self._pending_sweep = self.add_task(self._sweep_pending())
+
+    async def _sweep_pending(self):
+        while True:
+            deadlines = [
+                d
+                for d in (self._mqueue.next_deadline(), self._uqueue.next_deadline())
+                if d is not None
+            ]
+            if not deadlines:
+                break
+            await asyncio.sleep(max(0.0, min(deadlines) - time.monotonic()))
+            self._expire_pending()
 
     async def handle_gparticipants(self, cmd: Command):
         """
@@ -934,16 +1463,15 @@ class Room(WebsocketConnection, EventHandler):
         Format: gparticipants:numAnons:SSID:TIME:COOKIE:NAME:ALIAS:IP;...
         """
         args = cmd.args
+        # Only report differences when refreshing a list we already had
+        refresh = self._anoncount is not None
         self._anoncount = int(args[0])
-        self._userdict = dict()
-
-        # Only anons in chat
-        if len(args) == 1:
-            self.call_event("participants")
-            return
 
         raw_list = ":".join(args[1:])
-        for record in raw_list.split(";"):
+        seen = set()
+        changes = []
+        # Only anons in chat when there are no records
+        for record in raw_list.split(";") if raw_list else []:
             data = record.split(":")
 
             ssid = data[0]
@@ -952,6 +1480,13 @@ class Room(WebsocketConnection, EventHandler):
             name = data[3] if data[3] != "None" else None
             alias = data[4] if data[4] != "None" else None
             ip = data[5] or None
+            seen.add(ssid)
+
+            # Unchanged sessions are kept as is without resolving the user again
+            session = self._participants.get(ssid)
+            if session and self._session_matches(session, cookie, name, alias, ip):
+                continue
+            previous = session.user if session else None
 
             ts_short = contime.split(".")[0][-4:].zfill(4)
 
@@ -962,24 +1497,39 @@ class Room(WebsocketConnection, EventHandler):
             else:
                 user = UserManager.get_user(aid=cookie, ts_short=ts_short)
 
-            session = Session(
-                user=user,
-                room=self,
-                ssid=ssid,
-                short_cookie=cookie,
-                ip=ip,
-                conn_time=contime,
-            )
-            user.add_session(session)
-            self._userdict[ssid] = session
+            self._track_participant(user, ssid, cookie, ip, contime)
+            if previous is None:
+                changes.append(("join", user))
+            elif previous is not user:
+                changes.append((self._auth_event(name, alias), user))
 
             # If this is our own SSID, update our main session
             # Note: We still don't have a foolproof way to know which SSID is ours
             # but if IP and name match, it's a good guess.
             # For now, just ensure we don't overwrite auth_token.
 
+        for session in [s for s in self._participants if s.ssid not in seen]:
+            self._participants.remove(session.ssid)
+            changes.append(("leave", session.user))
+
+        if refresh:
+            for event, user in changes:
+                self.call_event(event, user)
         self.call_event("participants")
 
+    @staticmethod
+    def _session_matches(session: Session, cookie, name, alias, ip) -> bool:
+        """Checks a gparticipants record against an existing session."""
+        if session.short_cookie != cookie or session.ip != ip:
+            return False
+        user = session.user
+        if name:
+            return not user.isanon and user.name == name.lower()
+        elif alias:
+            return user.istemp and user.name == alias.lower()
+        else:
+            return user.isanon and not user.istemp
+
     async def handle_participant(self, cmd: Command):
         """
         Processes the 'participant' command which signals a single user
@@ -1005,19 +1555,8 @@ class Room(WebsocketConnection, EventHandler):
         else:
             user = UserManager.get_user(aid=cookie, ts_short=ts_short)
 
-        session = Session(
-            user=user,
-            room=self,
-            ssid=ssid,
-            short_cookie=cookie,
-            ip=ip,
-            conn_time=contime,
-        )
-        user.add_session(session)
-        self._userdict[ssid] = session
-
         if status == "0":  # Leave
-            self._userdict.pop(ssid)
+            self._participants.remove(ssid)
 
             if user.isanon:
                 if self._anoncount:
@@ -1026,6 +1565,7 @@ class Room(WebsocketConnection, EventHandler):
             self.call_event("leave", user)
 
         elif status == "1":  # Join
+            self._track_participant(user, ssid, cookie, ip, contime)
             if user.isanon:
                 if self._anoncount:
                     self._anoncount += 1
@@ -1033,16 +1573,48 @@ class Room(WebsocketConnection, EventHandler):
             self.call_event("join", user)
 
         elif status == "2":  # Auth Change (Login/Logout)
+            self._track_participant(user, ssid, cookie, ip, contime)
             if name:
                 if self._anoncount:
                     self._anoncount -= 1
 
-            if name or alias:
-                self.call_event("login", user)
-            else:
+            event = self._auth_event(name, alias)
+            if event == "logout":
                 if self._anoncount:
                     self._anoncount += 1
-                self.call_event("logout", user)
+            self.call_event(event, user)
+
+    @staticmethod
+    def _auth_event(name, alias) -> str:
+        """
+        Names the event for a session that changed user. Picking a temporary
+        alias counts as a login, the same as signing in with an account.
+        """
+        return "login" if name or alias else "logout"
+
+    def _track_participant(self, user, ssid, cookie, ip, contime) -> Session:
+        """Creates the session for an SSID, or reuses and updates the existing one."""
+        session = self._participants.get(ssid)
+        if session is None:
+            session = Session(
+                user=user,
+                room=self,
+                ssid=ssid,
+                short_cookie=cookie,
+                ip=ip,
+                conn_time=contime,
+            )
+            self._participants.add(session)
+        elif (
+            session.user is not user
+            or session.ip != ip
+            or session.short_cookie != cookie
+        ):
+            if session.user is not user:
+                session.user.remove_session(session)
+            self._participants.update(session, user=user, short_cookie=cookie, ip=ip)
+        user.add_session(session)
+        return session
 
     async def handle_mods(self, cmd: Command):
         args = cmd.args
@@ -1085,19 +1657,19 @@ class Room(WebsocketConnection, EventHandler):
         time_stamp = float(args[4])
 
         if name == "":
-            msx = [msg for msg in self._history if msg.encoded_cookie == encoded_cookie]
+            msx = self._history.by_cookie(encoded_cookie)
             target = msx[0].user if msx else UserManager.get_user(aid=encoded_cookie)
         else:
             target = UserManager.get_user(name=name)
 
-        self._banlist[target] = self._BANDATA(
-            encoded_cookie, ip, target, time_stamp, moderator
+        self._banlist.add(
+            self._BANDATA(encoded_cookie, ip, target, time_stamp, moderator)
         )
         self.call_event("blocked", target, moderator)
 
     async def handle_blocklist(self, cmd: Command):
         args = cmd.args
-        self._banlist = dict()
+        records = []
         sections = ":".join(args).split(";")
         for section in sections:
             params = section.split(":")
@@ -1115,9 +1687,10 @@ class Room(WebsocketConnection, EventHandler):
             else:
                 user = UserManager.get_user(name=name)
 
-            self._banlist[user] = self._BANDATA(
-                encoded_cookie, ip, user, time_stamp, moderator
+            records.append(
+                self._BANDATA(encoded_cookie, ip, user, time_stamp, moderator)
             )
+        self._banlist.replace(records)
         self.call_event("blocklist")
 
     async def handle_unblocked(self, cmd: Command):
@@ -1145,21 +1718,18 @@ class Room(WebsocketConnection, EventHandler):
 
             # 2. Clean up _banlist
             # Search by cookie first
-            found = False
-            for u, data in list(self._banlist.items()):
-                if data.encoded_cookie == cookie:
-                    self._banlist.pop(u, None)
-                    found = True
-                    break
+            records = self._banlist.by_cookie(cookie) if cookie else []
 
             # Fallback: Search by IP if not found by cookie
-            if not found:
-                for u, data in list(self._banlist.items()):
-                    if data.ip == ip:
-                        # For registered users, also match the name
-                        if not name or u.name == name.lower():
-                            self._banlist.pop(u, None)
-                            break
+            if not records and ip:
+                records = [
+                    data
+                    for data in self._banlist.by_ip(ip)
+                    # For registered users, also match the name
+                    if not name or data.target.name == name.lower()
+                ]
+            if records:
+                self._banlist.remove(records[0])
 
             # 3. Trigger Event (target only)
             self.call_event("unblocked", target)
@@ -1225,12 +1795,14 @@ class Room(WebsocketConnection, EventHandler):
         self.call_event("temp_ban", int(args[0]))
 
     async def handle_updgroupinfo(self, cmd: Command):
+        resource_cache.invalidate(self.name, [RoomProfile])
         await self.load_profile()
         # load_profile calls "profile" event
 
     async def handle_miu(self, cmd: Command):
         args = cmd.args
         user = UserManager.get_user(name=args[0])
+        resource_cache.invalidate(user.name, user_resource_types)
         await user.load_resources()
         self.call_event("miu", user)
 
@@ -1290,6 +1862,7 @@ class Room(WebsocketConnection, EventHandler):
     async def handle_updateprofile(self, cmd: Command):
         args = cmd.args
         user = UserManager.get_user(name=args[0])
+        resource_cache.invalidate(user.name, user_resource_types)
         await user.load_resources()
         self.call_event("updateprofile", user)
 
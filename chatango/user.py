@@ -6,7 +6,7 @@ from collections import deque
 
 from .utils import public_attributes
 from .resources import (
-    fetch_resources,
+    user_resource_types,
     PathProvider,
     Styles,
     UserProfile,
@@ -128,6 +128,12 @@ class User:
         """Base users cannot save background."""
         return False
 
+    async def upload_image(
+        self, password: str, path: str, return_url: bool = False
+    ) -> Optional[str]:
+        """Base users cannot upload images."""
+        return None
+
     def clear_styles(self):
         """Base users have no style data to clear."""
         pass
@@ -192,6 +198,9 @@ class User:
     def add_session(self, session):
         self._sessions.add(session)
 
+    def remove_session(self, session):
+        self._sessions.discard(session)
+
     def get_sessions(self, room=None):
         if room:
             return {s for s in self._sessions if s.room == room}
@@ -232,9 +241,10 @@ class RegisteredUser(User):
 
     async def load_resources(self):
         """Fetches all user resource files and updates instances."""
-        results = await fetch_resources(
-            self.name, [Styles, UserProfile, MessageBackground]
-        )
+        # The fetch module loads aiohttp, users are created without it
+        from .fetch import fetch_resources
+
+        results = await fetch_resources(self.name, list(user_resource_types))
         if len(results) == 3:
             self._styles = results[0]
             self._profile = results[1]
@@ -272,6 +282,20 @@ class RegisteredUser(User):
 
         return bg_success and style_success
 
+    async def upload_image(
+        self, password: str, path: str, return_url: bool = False
+    ) -> Optional[str]:
+        """
+        Uploads an image file to this account.
+        @return: img tag to put in a message, or its URL if return_url is set
+        """
+        from .fetch import upload_image
+
+        handle = self.name
+        if not handle:
+            return None
+        return await upload_image(handle, password, path, return_url)
+
     def clear_styles(self):
         """Resets the style data to defaults."""
         self._styles = Styles()
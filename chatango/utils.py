@@ -1,15 +1,18 @@
 import random
-import mimetypes
 import html
 import re
 import string
-import aiohttp
-import ssl
 import logging
-from typing import Optional, Tuple
+from bisect import bisect_left
+from collections import deque
+from functools import lru_cache
+from itertools import accumulate
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 from .hasher import Hasher
 
+logger = logging.getLogger(__name__)
+
 # fmt: off
 specials = {
     'mitvcanal': 56, 'animeultimacom': 34, 'cricket365live': 21,
@@ -87,10 +90,30 @@ tshashes = {
 }
 
 
+def _server_table(weights):
+    """
+    Cumulative frequency table for the weighted server pick.
+
+    Frequencies are accumulated in the same order and with the same float
+    arithmetic as the original linear scan, so a bisect over the table
+    selects exactly the same server.
+    """
+    maxnum = sum(y for x, y in weights)
+    cumfreqs = list(accumulate(float(y) / maxnum for x, y in weights))
+    return [x for x, y in weights], cumfreqs
+
+
+_servers, _cumfreqs = _server_table(tsweights)
+
+
+@lru_cache(maxsize=4096)
 def get_server(group):
     """
     Get the server host for a certain room.
 
+    Results are memoized; call get_server.cache_clear() after changing
+    specials, tshashes or tsweights at runtime.
+
     @type group: str
     @param group: room name
 
@@ -112,156 +135,135 @@ def get_server(group):
         else:
             lnv = 1000
         num = (fnv % lnv) / lnv
-        maxnum = sum(y for x, y in tsweights)
-        cumfreq = 0
-        sn = 0
-        for x, y in tsweights:
-            cumfreq += float(y) / maxnum
-            if num <= cumfreq:
-                sn = x
-                break
+        i = bisect_left(_cumfreqs, num)
+        sn = _servers[i] if i < len(_servers) else 0
     return f"s{sn}.chatango.com"
 
 
+def resolve_servers(groups: Iterable[str]) -> Dict[str, str]:
+    """
+    Get the server hosts for many rooms at once.
+
+    @param groups: room names
+    @return: dict mapping each room name to its server's hostname
+    """
+    return {group: get_server(group) for group in groups}
+
+
 def public_attributes(obj):
     return [
         x for x in set(list(obj.__dict__.keys()) + list(dir(type(obj)))) if x[0] != "_"
     ]
 
 
-async def on_request_exception(session, context, params):
-    logging.getLogger("aiohttp.client").debug(f"on request exception: <{params}>")
-
+class LatencyStats:
+    """Running latency figures plus a window of recent samples."""
 
-def trace():
-    trace_config = aiohttp.TraceConfig()
-    trace_config.on_request_exception.append(on_request_exception)
-    return trace_config
+    window = 512
 
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=self.window)
 
-_aiohttp_session = None
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self._recent.append(seconds)
 
+    def percentile(self, p: float) -> float:
+        """Percentile (0-100) of the recent samples."""
+        if not self._recent:
+            return 0.0
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
 
-def get_aiohttp_session():
-    global _aiohttp_session
-    if _aiohttp_session is None:
-        # Chatango uses legacy TLS configurations on some server ports (e.g. PM 8081)
-        # We must lower the security level to allow negotiation with these hosts.
-        ssl_context = ssl.create_default_context()
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max,
+        }
 
-        # 0x4 is the underlying OpenSSL value for OP_LEGACY_SERVER_CONNECT
-        # This allows connecting to servers that don't support RFC 5746 (renegotiation)
-        ssl_context.options |= 0x4
 
-        # Lower security level to 1 to allow older ciphers/hashes used by Chatango
-        try:
-            ssl_context.set_ciphers("DEFAULT@SECLEVEL=1")
-        except ssl.SSLError:
-            # Fallback if SECLEVEL is not supported by the system's OpenSSL
-            pass
-
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
+class HttpMetrics:
+    """
+    Per host HTTP metrics fed by the trace hooks of the shared session.
+
+    Latencies, in seconds:
+    - dns: host resolution, when not answered from the DNS cache
+    - connect: new connection setup after DNS, TLS handshake included
+    - queued: time waiting for a free connection in the pool
+    - ttfb: request start until response headers
+    - handshake: websocket connect, from DNS to the protocol upgrade
+    Counters: requests, new connections, reused connections, errors, and
+    tls_resumed/tls_full websocket handshakes.
+    """
 
-        timeout = aiohttp.ClientTimeout(total=30, connect=10)
-        _aiohttp_session = aiohttp.ClientSession(
-            connector=connector, timeout=timeout, trace_configs=[trace()]
-        )
-    return _aiohttp_session
-
-
-async def get_token(user_name, passwd):
-    chatango, token = ["http://chatango.com/login", "auth.chatango.com"], None
-    payload = {
-        "user_id": str(user_name).lower(),
-        "password": str(passwd),
-        "storecookie": "on",
-        "checkerrors": "yes",
-    }
-    # Use fresh session to retrieve auth cookies
-    async with aiohttp.ClientSession() as session:
-        async with session.post(chatango[0], data=payload) as resp:
-            if chatango[1] in resp.cookies:
-                token = str(resp.cookies[chatango[1]]).split("=")[1].split(";")[0]
-    return token
-
-
-def multipart(data, files, boundary=None):
-    lineas = []
-
-    def escape_quote(s):
-        return s.replace('"', '\\"')
-
-    if boundary == None:
-        boundary = "".join(
-            random.choice(string.digits + string.ascii_letters) for x in range(30)
-        )
-    for nombre, valor in data.items():
-        lineas.extend(
-            (
-                "--%s" % boundary,
-                'Content-Disposition: form-data; name="%s"' % nombre,
-                "",
-                str(valor),
-            )
-        )
-    for nombre, valor in files.items():
-        filename = valor["filename"]
-        if "mimetype" in valor:
-            mimetype = valor["mimetype"]
-        else:
-            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
-        lineas.extend(
-            (
-                "--%s" % boundary,
-                'Content-Disposition: form-data; name="%s"; '
-                'filename="%s"' % (escape_quote(nombre), escape_quote(filename)),
-                "Content-Type: %s" % mimetype,
-                "",
-                valor["content"],
-            )
-        )
-    lineas.extend(
-        (
-            "--%s--" % boundary,
-            "",
-        )
-    )
-    body = "\r\n".join(lineas)
-    headers = {
-        "Content-Type": "multipart/form-data; boundary=%s" % boundary,
-        "Content-Length": str(len(body)),
-    }
-    return body, headers
-
-    # async def upload_image(self, path, return_url=False):
-    #     if self.user.isanon:
-    #         return None
-    #     with open(path, mode="rb") as f:
-    #         files = {
-    #             "filedata": {"filename": path, "content": f.read().decode("latin-1")}
-    #         }
-    #     data, headers = multipart(
-    #         dict(u=self.client._default_user_name, p=self.client._default_password),
-    #         files,
-    #     )
-    #     headers.update({"host": "chatango.com", "origin": "http://st.chatango.com"})
-    #     async with get_aiohttp_session().post(
-    #         "http://chatango.com/uploadimg",
-    #         data=data.encode("latin-1"),
-    #         headers=headers,
-    #     ) as resp:
-    #         response = await resp.text()
-    #         if "success" in response:
-    #             success = response.split(":", 1)[1]
-    #     if success != None:
-    #         if return_url:
-    #             url = "http://ust.chatango.com/um/{}/{}/{}/img/t_{}.jpg"
-    #             return url.format(
-    #                 self.user.name[0], self.user.name[1], self.user.name, success
-    #             )
-    #         else:
-    #             return f"img{success}"
-    #     return None
+    def __init__(self):
+        self.latencies: Dict[str, Dict[str, LatencyStats]] = dict()
+        self.counters: Dict[str, Dict[str, int]] = dict()
+
+    def record(self, host: str, name: str, seconds: float):
+        stats = self.latencies.setdefault(host, dict())
+        if name not in stats:
+            stats[name] = LatencyStats()
+        stats[name].add(seconds)
+
+    def incr(self, host: str, name: str):
+        counters = self.counters.setdefault(host, dict())
+        counters[name] = counters.get(name, 0) + 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        hosts = set(self.latencies) | set(self.counters)
+        return {
+            host: {
+                **self.counters.get(host, dict()),
+                **{
+                    name: stats.to_dict()
+                    for name, stats in self.latencies.get(host, dict()).items()
+                },
+            }
+            for host in sorted(hosts)
+        }
+
+    def reset(self):
+        self.latencies.clear()
+        self.counters.clear()
+
+
+http_metrics = HttpMetrics()
+
+# Network helpers that now live in the http module, still importable from
+# here without making this module import aiohttp
+_moved_to_http = (
+    "PoolConfig",
+    "TokenManager",
+    "close_aiohttp_session",
+    "configure_pool",
+    "get_aiohttp_session",
+    "get_ssl_context",
+    "get_token",
+    "multipart",
+    "multipart_writer",
+    "on_request_exception",
+    "pool_config",
+    "prewarm_dns",
+    "token_manager",
+    "trace",
+)
+
+
+def __getattr__(name):
+    if name in _moved_to_http:
+        from . import http
+
+        return getattr(http, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def gen_uid() -> str: